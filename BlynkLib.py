@@ -1,15 +1,24 @@
+import array
 import socket
 import struct
 import time
 import os
 import machine
 import wipy
+try:
+    import select
+except ImportError:
+    select = None
 
 HDR_LEN = const(5)
 HDR_FMT = "!BHH"
 
 MAX_MSG_PER_SEC = const(20)
 
+TERM_BUF_LEN = const(128)
+TERM_FLUSH_MS = const(100)
+TERM_BULK_PERIOD = const(100) # one chunk every 100 ms, half the tx budget
+
 MSG_RSP = const(0)
 MSG_LOGIN = const(2)
 MSG_PING  = const(6)
@@ -17,6 +26,7 @@ MSG_TWEET = const(12)
 MSG_EMAIL = const(13)
 MSG_NOTIFY = const(14)
 MSG_BRIDGE = const(15)
+MSG_HW_SYNC = const(16)
 MSG_HW = const(20)
 
 STA_SUCCESS = const(200)
@@ -25,7 +35,10 @@ HB_PERIOD = const(10)
 NON_BLK_SOCK = const(0)
 MIN_SOCK_TO = const(1) # 1 second
 MAX_SOCK_TO = const(5) # 5 seconds, must be < HB_PERIOD
+HB_MIN_TO = const(2000) # the adaptive heartbeat timeout stays between this and MAX_SOCK_TO
+HB_MAX_SKIP = const(6) # ping at least every 6 periods to keep measuring the rtt
 WDT_TO = const(10000) # 10 seconds
+CONNECT_STALL = const(15000) # connect, TLS handshake and login, up to MAX_SOCK_TO each
 RECONNECT_DELAY = const(1) # 1 second
 TASK_PERIOD_RES = const(50) # 50 ms
 IDLE_TIME_MS = const(5) # 5 ms
@@ -34,6 +47,29 @@ RE_TX_DELAY = const(2)
 MAX_TX_RETRIES = const(3)
 
 MAX_VIRTUAL_PINS = const(32)
+MAX_HW_ARGS = const(32)
+TX_BUF_LEN = const(256)
+
+# hardware commands, keyed by their first two characters
+CMD_PM = const(0x706D) # 'pm'
+CMD_VW = const(0x7677) # 'vw'
+CMD_VR = const(0x7672) # 'vr'
+CMD_DW = const(0x6477) # 'dw'
+CMD_AW = const(0x6177) # 'aw'
+CMD_DR = const(0x6472) # 'dr'
+CMD_AR = const(0x6172) # 'ar'
+
+CA_CERTS = '/flash/cert/ca.pem'
+
+STATE_FMT = "<BH" # state file records: dirty flag and length, then the 'vw' message body
+STATE_SAVE_DELAY = const(2000) # coalesce the writes of a slider into one save
+
+# capture file records: kind, ms since the capture started, length, then the bytes
+CAP_FMT = "<BIH"
+CAP_HDR_LEN = const(7)
+CAP_RX = const(0)
+CAP_TX = const(1)
+CAP_CONNECT = const(2)
 
 DISCONNECTED = 0
 CONNECTING = 1
@@ -47,6 +83,69 @@ def sleep_from_until (start, delay):
         machine.idle()
     return start + delay
 
+def _atoi(data, start, end):
+    # parse a decimal integer in place, without slicing the buffer
+    neg = start < end and data[start] == 0x2D # '-'
+    if neg:
+        start += 1
+    if start >= end:
+        raise ValueError('')
+    val = 0
+    for i in range(start, end):
+        c = data[i] - 0x30
+        if c < 0 or c > 9:
+            raise ValueError('')
+        val = val * 10 + c
+    return -val if neg else val
+
+def _encode(buf, pos, arg):
+    # write one message argument at buf[pos:] and return the end position,
+    # or -1 if it doesn't fit. bools keep their str() form ('True'/'False')
+    if isinstance(arg, int) and not isinstance(arg, bool):
+        if arg < 0:
+            if pos >= len(buf):
+                return -1
+            buf[pos] = 0x2D # '-'
+            pos += 1
+            arg = -arg
+        end = pos + 1
+        val = arg // 10
+        while val:
+            end += 1
+            val //= 10
+        if end > len(buf):
+            return -1
+        i = end
+        while i > pos:
+            i -= 1
+            buf[i] = 0x30 + arg % 10
+            arg //= 10
+        return end
+    if isinstance(arg, (bytes, bytearray, memoryview)):
+        end = pos + len(arg)
+        if end > len(buf):
+            return -1
+        buf[pos:end] = arg
+        return end
+    if not isinstance(arg, str):
+        arg = str(arg)
+    end = pos + len(arg)
+    if end > len(buf):
+        return -1
+    for c in arg:
+        c = ord(c)
+        if c > 0x7F:
+            raise ValueError('')
+        buf[pos] = c
+        pos += 1
+    return end
+
+def _arg_bytes(arg):
+    # the same encoding as _encode, for the messages which don't fit the buffer
+    if isinstance(arg, (bytes, bytearray, memoryview)):
+        return bytes(arg)
+    return bytes(str(arg), 'ascii')
+
 class HwPin:
     _PWMMap = {'GP9': 3, 'GP10': 3, 'GP11': 3, 'GP24': 5, 'GP25': 9}
     _TimerMap = { 'GP9': (3, machine.Timer.B),
@@ -56,13 +155,17 @@ class HwPin:
                  'GP25': (2, machine.Timer.A)}
 
     _HBPin = 25 if 'WiPy' in os.uname().machine else 9
+    _adc = None # shared by all the analog pins
 
-    def __init__(self, pin_num, mode, pull):
+    __slots__ = ('_mode', '_pull', '_function', '_pin', '_apin', '_pwm', '_name', '_sampler')
+
+    def __init__(self, pin_num, mode, pull, sampler=None):
         self._mode = mode
         self._pull = pull
         self._function = ''
         self._pin = None
         self._apin = None
+        self._sampler = sampler
         self._pwm = None
         pin_num = int(pin_num)
         self._name = 'GP' + str(pin_num)
@@ -70,6 +173,8 @@ class HwPin:
             wipy.heartbeat(False)
 
     def _config(self, duty_cycle=0):
+        # the peripheral objects are created once and kept, switching the
+        # function again only moves the pin mux back
         if self._function == 'dig':
             _mode = machine.Pin.OUT if self._mode == 'out' else machine.Pin.IN
             if self._pull == 'pu':
@@ -78,14 +183,30 @@ class HwPin:
                 _pull = machine.Pin.PULL_DOWN
             else:
                 _pull = None
-            self._pin = machine.Pin(self._name, mode=_mode, pull=_pull, drive=machine.Pin.MED_POWER)
+            if self._pin is None:
+                self._pin = machine.Pin(self._name, mode=_mode, pull=_pull, drive=machine.Pin.MED_POWER)
+            else:
+                self._pin.init(mode=_mode, pull=_pull, drive=machine.Pin.MED_POWER)
         elif self._function == 'ana':
-            adc = machine.ADC(bits=12)
-            self._apin = adc.channel(pin=self._name)
+            if self._sampler:
+                # sampled in the background, _apin holds the channel index
+                self._apin = self._sampler.add(self._name)
+            elif self._apin is None:
+                if HwPin._adc is None:
+                    HwPin._adc = machine.ADC(bits=12)
+                self._apin = HwPin._adc.channel(pin=self._name)
+            else:
+                self._apin.init()
         else:
-            machine.Pin(self._name, mode=machine.Pin.ALT, pull=None, drive=machine.Pin.MED_POWER, alt=HwPin._PWMMap[self._name])
-            timer = machine.Timer(HwPin._TimerMap[self._name][0], mode=machine.Timer.PWM)
-            self._pwm = timer.channel(HwPin._TimerMap[self._name][1], freq=20000, duty_cycle=duty_cycle)
+            if self._pin is None:
+                self._pin = machine.Pin(self._name, mode=machine.Pin.ALT, pull=None, drive=machine.Pin.MED_POWER, alt=HwPin._PWMMap[self._name])
+            else:
+                self._pin.init(mode=machine.Pin.ALT, pull=None, drive=machine.Pin.MED_POWER, alt=HwPin._PWMMap[self._name])
+            if self._pwm is None:
+                timer = machine.Timer(HwPin._TimerMap[self._name][0], mode=machine.Timer.PWM)
+                self._pwm = timer.channel(HwPin._TimerMap[self._name][1], freq=20000, duty_cycle=duty_cycle)
+            else:
+                self._pwm.duty_cycle(duty_cycle)
 
     def digital_read(self):
         if self._function != 'dig':
@@ -103,6 +224,8 @@ class HwPin:
         if self._function != 'ana':
             self._function = 'ana'
             self._config()
+        if self._sampler:
+            return self._sampler.read(self._apin)
         return self._apin()
 
     def analog_write(self, value):
@@ -113,6 +236,8 @@ class HwPin:
             self._pwm.duty_cycle(value)
 
 class VrPin:
+    __slots__ = ('read', 'write')
+
     def __init__(self, read=None, write=None):
         self.read = read
         self.write = write
@@ -121,9 +246,79 @@ class Terminal:
     def __init__(self, blynk, pin):
         self._blynk = blynk
         self._pin = pin
+        self._buf = bytearray(TERM_BUF_LEN)
+        self._mv = memoryview(self._buf)
+        self._len = 0
+        self._time = 0
+        self._bulk = None
+        self._bulk_pos = 0
+        self._bulk_time = 0
+        self._bulk_wait = 0
 
     def write(self, data):
-        self._blynk.virtual_write(self._pin, data)
+        # output is collected and sent on newline, when the buffer is full
+        # or TERM_FLUSH_MS after the first byte came in (see poll)
+        if isinstance(data, str):
+            data = data.encode()
+        buf = self._buf
+        if isinstance(data, memoryview):
+            # 'in' doesn't search a memoryview, only the bytes it's made of
+            newline = b'\n' in bytes(data)
+        else:
+            newline = b'\n' in data
+        src = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            if self._len == 0:
+                self._time = time.ticks_ms()
+            n = min(len(data) - pos, len(buf) - self._len)
+            buf[self._len:self._len + n] = src[pos:pos + n]
+            self._len += n
+            pos += n
+            if self._len == len(buf):
+                self.flush()
+        if newline:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._len:
+            self._blynk.virtual_write(self._pin, self._mv[:self._len])
+            self._len = 0
+
+    def dump(self, data):
+        """
+        Send a large output (logs, stats) in TERM_BUF_LEN chunks, paced so
+        that the rest of the traffic keeps its share of MAX_MSG_PER_SEC.
+        """
+        self.flush()
+        self._bulk = data.encode() if isinstance(data, str) else data
+        self._bulk_pos = 0
+        self._bulk_time = time.ticks_ms()
+        self._bulk_wait = 0
+
+    def timeout(self, c_millis):
+        # ms until poll has something to do next, None if idle
+        if self._bulk is not None:
+            return self._bulk_wait - time.ticks_diff(self._bulk_time, c_millis)
+        if self._len:
+            return TERM_FLUSH_MS - time.ticks_diff(self._time, c_millis)
+        return None
+
+    def poll(self):
+        c_millis = time.ticks_ms()
+        if self._len and time.ticks_diff(self._time, c_millis) >= TERM_FLUSH_MS:
+            self.flush()
+        if self._bulk is not None and time.ticks_diff(self._bulk_time, c_millis) >= self._bulk_wait:
+            blynk = self._blynk
+            if blynk._tx_count < MAX_MSG_PER_SEC // 2:
+                end = self._bulk_pos + TERM_BUF_LEN
+                blynk.virtual_write(self._pin, memoryview(self._bulk)[self._bulk_pos:end])
+                self._bulk_pos = end
+                if end >= len(self._bulk):
+                    self._bulk = None
+            self._bulk_time = c_millis
+            self._bulk_wait = TERM_BULK_PERIOD
 
     def read(self, size):
         return ''
@@ -143,12 +338,18 @@ class Terminal:
                 print('Exception:\n  ' + repr(e))
 
 class Blynk:
-    def __init__(self, token, server='cloud.blynk.cc', port=None, connect=True, wdt=True, ssl=False):
+    def __init__(self, token, server='cloud.blynk.cc', port=None, connect=True, wdt=True, ssl=False, ca_certs=CA_CERTS,
+                 bulk=False, capture=None, state_file=None, sampler=None):
         self._wdt = None
         self._vr_pins = {}
+        self._terms = []
         self._do_connect = False
         self._task = None
         self._task_period = 0
+        self._idle_task = None
+        self._mem_handler = None
+        self._sv_task = None
+        self.conn = None
         self._token = token
         if isinstance (self._token, str):
             self._token = bytes(token, 'ascii')
@@ -162,51 +363,208 @@ class Blynk:
         self._do_connect = connect
         self._wdt = wdt
         self._ssl = ssl
+        self._ca_certs = ca_certs
+        self._ssl_mod = None
+        self._ssl_ctx = None
+        self._ssl_session = None
+        self._ssl_resume = False
+        self._want_io = ()
+        self._tx_buf = bytearray(TX_BUF_LEN)
+        self._bulk = bulk
+        self._batch_buf = bytearray(TX_BUF_LEN) if bulk else None
+        self._cap = None
+        if capture:
+            self.start_capture(capture)
+        self._batch_len = 0
+        self._batch_msgs = 0
+        self._tx_mv = memoryview(self._tx_buf)
+        self._hw_offs = array.array('H', [0] * (MAX_HW_ARGS + 1))
+        self._hw_text = None
+        self._hw_cmds = {CMD_PM: self._hw_pm, CMD_VW: self._hw_vw, CMD_VR: self._hw_vr,
+                         CMD_DW: self._hw_dw, CMD_AW: self._hw_aw, CMD_DR: self._hw_dr, CMD_AR: self._hw_ar}
+        self._poller = None
+        self.stats = {'connects': 0, 'conn_fails': 0, 'connect_ms': 0, 'tls_ms': 0, 'tls_resumed': 0,
+                      'idle_ms': 0, 'busy_ms': 0, 'wakeups': 0, 'pings': 0, 'pings_skipped': 0,
+                      'hb_timeouts': 0, 'rtt_min': 0, 'rtt_avg': 0, 'rtt_max': 0, 'hb_timeout': MAX_SOCK_TO * 1000,
+                      'state_restored': 0, 'state_pushed': 0, 'state_synced': 0, 'mem_errors': 0}
+        self._rtt_sum = 0
+        self._rtt_count = 0
+        # last 'vw' body of the pins added with cache=True, persisted in state_file
+        self._state_file = state_file
+        self._sampler = sampler
+        self._state = {}
+        self._state_pins = set()
+        self._state_dirty = set()
+        self._state_save = None # ticks_ms of the last unsaved change
+        self._state_loaded = False
+        self._msg_id = 1
+        self._srtt = 0
+        self._rttvar = 0
         self.state = DISCONNECTED
 
+    def _format_hdr(self, msg_type, msg_id, value):
+        struct.pack_into(HDR_FMT, self._tx_buf, 0, msg_type, msg_id, value)
+        return self._tx_mv[:HDR_LEN]
+
     def _format_msg(self, msg_type, *args):
-        data = bytes('\0'.join(map(str, args)), 'ascii')
-        return struct.pack(HDR_FMT, msg_type, self._new_msg_id(), len(data)) + data
+        # encode straight into the transmit buffer, the returned memoryview
+        # is only valid until the next message is formatted
+        buf = self._tx_buf
+        pos = HDR_LEN
+        for arg in args:
+            pos = _encode(buf, pos, arg)
+            if pos < 0 or pos >= len(buf):
+                # doesn't fit, fall back to building it in a new buffer
+                data = b'\0'.join(map(_arg_bytes, args))
+                return struct.pack(HDR_FMT, msg_type, self._new_msg_id(), len(data)) + data
+            buf[pos] = 0
+            pos += 1
+        if args:
+            pos -= 1 # drop the last separator
+        struct.pack_into(HDR_FMT, buf, 0, msg_type, self._new_msg_id(), pos - HDR_LEN)
+        return self._tx_mv[:pos]
+
+    def _hw_split(self, data):
+        # store the start offset of every NUL separated field, the field
+        # k spans data[offs[k]:offs[k + 1] - 1]. Returns the field count
+        offs = self._hw_offs
+        n = 0
+        pos = data.find(b'\0')
+        while pos >= 0:
+            n += 1
+            if n + 1 >= len(offs):
+                # more fields than any message before, grow instead of merging them
+                offs.append(0)
+            offs[n] = pos + 1
+            pos = data.find(b'\0', pos + 1)
+        offs[n + 1] = len(data) + 1
+        return n + 1
+
+    def _hw_int(self, data, idx):
+        offs = self._hw_offs
+        return _atoi(data, offs[idx], offs[idx + 1] - 1)
+
+    def _hw_str(self, data, idx):
+        # the message is decoded once on the first string field, every
+        # field after that costs just the str slice
+        if self._hw_text is None:
+            self._hw_text = str(data, 'ascii')
+        offs = self._hw_offs
+        return self._hw_text[offs[idx]:offs[idx + 1] - 1]
+
+    def _hw_pm(self, data, n):
+        for i in range(1, n - 1, 2):
+            pin = self._hw_int(data, i)
+            mode = self._hw_str(data, i + 1)
+            if mode != 'in' and mode != 'out' and mode != 'pu' and mode != 'pd':
+                raise ValueError('')
+            self._hw_pins[pin] = HwPin(pin, mode, mode, self._sampler)
+        self._pins_configured = True
+
+    def _hw_vw(self, data, n):
+        pin = self._hw_int(data, 1)
+        vr_pin = self._vr_pins.get(pin)
+        if vr_pin and vr_pin.write:
+            for i in range(2, n):
+                vr_pin.write(self._hw_str(data, i))
+        if pin in self._state_pins:
+            self._keep_state(pin, data, False)
+
+    def _keep_state(self, pin, data, dirty):
+        # dirty values were set locally while offline, the server doesn't have them yet
+        if self._state.get(pin) != data:
+            self._state[pin] = bytes(data)
+            self._state_save = time.ticks_ms()
+        if dirty:
+            self._state_dirty.add(pin)
+        elif pin in self._state_dirty:
+            self._state_dirty.discard(pin)
+
+    def _save_state(self, force=False):
+        if self._state_save is not None and self._state_file and \
+           (force or time.ticks_diff(self._state_save, time.ticks_ms()) >= STATE_SAVE_DELAY):
+            self._state_save = None
+            try:
+                with open(self._state_file, 'wb') as f:
+                    for pin, data in self._state.items():
+                        f.write(struct.pack(STATE_FMT, pin in self._state_dirty, len(data)))
+                        f.write(data)
+            except OSError:
+                pass
+
+    def _load_state(self):
+        # replay the saved values into the handlers, the app is ready before
+        # the first connection
+        self._state_loaded = True
+        try:
+            with open(self._state_file, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return
+        pos = 0
+        while pos + 3 <= len(raw):
+            dirty, length = struct.unpack_from(STATE_FMT, raw, pos)
+            pos += 3
+            data = raw[pos:pos + length]
+            pos += length
+            self._hw_split(data)
+            pin = self._hw_int(data, 1)
+            # values written before run() are newer
+            if pin in self._state_pins and pin not in self._state_dirty:
+                self._handle_hw(data)
+                self._keep_state(pin, data, dirty)
+                self.stats['state_restored'] += 1
+        self._state_save = None
+
+    def _sync_state(self):
+        # after connecting push what changed offline and ask the server only
+        # for the pins without a known value
+        unknown = []
+        for pin in self._state_pins:
+            if pin in self._state_dirty:
+                data = self._state[pin]
+                self._send(struct.pack(HDR_FMT, MSG_HW, self._new_msg_id(), len(data)) + data, True)
+                self.stats['state_pushed'] += 1
+            elif pin not in self._state:
+                unknown.append(pin)
+        self._state_dirty = set()
+        if unknown:
+            self._send(self._format_msg(MSG_HW_SYNC, 'vr', *unknown), True)
+            self.stats['state_synced'] += len(unknown)
+
+    def _hw_vr(self, data, n):
+        vr_pin = self._vr_pins.get(self._hw_int(data, 1))
+        if vr_pin and vr_pin.read:
+            vr_pin.read()
+
+    def _hw_dw(self, data, n):
+        if self._pins_configured:
+            self._hw_pins[self._hw_int(data, 1)].digital_write(self._hw_int(data, 2))
+
+    def _hw_aw(self, data, n):
+        if self._pins_configured:
+            self._hw_pins[self._hw_int(data, 1)].analog_write(self._hw_int(data, 2))
+
+    def _hw_dr(self, data, n):
+        if self._pins_configured:
+            pin = self._hw_int(data, 1)
+            val = self._hw_pins[pin].digital_read()
+            self._reply(self._format_msg(MSG_HW, 'dw', pin, val))
+
+    def _hw_ar(self, data, n):
+        if self._pins_configured:
+            pin = self._hw_int(data, 1)
+            val = self._hw_pins[pin].analog_read()
+            self._reply(self._format_msg(MSG_HW, 'aw', pin, val))
 
     def _handle_hw(self, data):
-        params = list(map(lambda x: x.decode('ascii'), data.split(b'\0')))
-        cmd = params.pop(0)
-        if cmd == 'info':
-            pass
-        elif cmd == 'pm':
-            pairs = zip(params[0::2], params[1::2])
-            for (pin, mode) in pairs:
-                pin = int(pin)
-                if mode != 'in' and mode != 'out' and mode != 'pu' and mode != 'pd':
-                    raise ValueError('')
-                self._hw_pins[pin] = HwPin(pin, mode, mode)
-            self._pins_configured = True
-        elif cmd == 'vw':
-            pin = int(params.pop(0))
-            if pin in self._vr_pins and self._vr_pins[pin].write:
-                for param in params:
-                    self._vr_pins[pin].write(param)
-        elif cmd == 'vr':
-            pin = int(params.pop(0))
-            if pin in self._vr_pins and self._vr_pins[pin].read:
-                self._vr_pins[pin].read()
-        elif self._pins_configured:
-            if cmd == 'dw':
-                pin = int(params.pop(0))
-                val = int(params.pop(0))
-                self._hw_pins[pin].digital_write(val)
-            elif cmd == 'aw':
-                pin = int(params.pop(0))
-                val = int(params.pop(0))
-                self._hw_pins[pin].analog_write(val)
-            elif cmd == 'dr':
-                pin = int(params.pop(0))
-                val = self._hw_pins[pin].digital_read()
-                self._send(self._format_msg(MSG_HW, 'dw', pin, val))
-            elif cmd == 'ar':
-                pin = int(params.pop(0))
-                val = self._hw_pins[pin].analog_read()
-                self._send(self._format_msg(MSG_HW, 'aw', pin, val))
+        n = self._hw_split(data)
+        self._hw_text = None
+        # every command is two characters long, longer or shorter first
+        # fields (e.g. 'dwx') are not commands even if their prefix matches
+        cmd = self._hw_cmds.get(data[0] << 8 | data[1]) if self._hw_offs[1] == 3 else None
+        if cmd:
+            cmd(data, n)
 
     def _new_msg_id(self):
         self._msg_id += 1
@@ -222,11 +580,20 @@ class Blynk:
     def _recv(self, length, timeout=0):
         self._settimeout (timeout)
         try:
-            self._rx_data += self.conn.recv(length)
+            data = self.conn.recv(length)
+            if data:
+                self._rx_time = time.ticks_ms()
+            if self._cap:
+                self._capture(CAP_RX, data)
+            if not data and length > 0:
+                # the server closed the connection, an empty read of an empty
+                # body is not a close
+                self._rx_closed = True
+            self._rx_data += data
         except socket.timeout:
             return b''
         except socket.error as e:
-            if e.args[0] ==  EAGAIN:
+            if e.args[0] == EAGAIN or isinstance(e, self._want_io):
                 return b''
             else:
                 raise
@@ -244,6 +611,9 @@ class Blynk:
                 try:
                     self.conn.send(data)
                     self._tx_count += 1
+                    self._tx_time = time.ticks_ms()
+                    if self._cap:
+                        self._capture(CAP_TX, data)
                     break
                 except socket.error as er:
                     if er.args[0] != EAGAIN:
@@ -252,36 +622,235 @@ class Blynk:
                         time.sleep_ms(RE_TX_DELAY)
                         retries += 1
 
+    def _capture(self, kind, data):
+        cap = self._cap
+        cap.write(struct.pack(CAP_FMT, kind, time.ticks_diff(self._cap_start, time.ticks_ms()), len(data)))
+        cap.write(data)
+
+    def start_capture(self, path):
+        """
+        Log the raw rx and tx byte streams with their timestamps to path,
+        for replaying them later (see tools/replay.py).
+        """
+        self.stop_capture()
+        self._cap = open(path, 'wb')
+        self._cap_start = time.ticks_ms()
+
+    def stop_capture(self):
+        if self._cap:
+            self._cap.close()
+            self._cap = None
+
+    def _tls_setup(self):
+        # import ssl and load the CA only once, reconnects reuse them
+        if self._ssl_mod is None:
+            import ssl
+            self._ssl_mod = ssl
+            if hasattr(ssl, 'SSLContext'):
+                self._ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                self._ssl_ctx.load_verify_locations(cafile=self._ca_certs)
+                self._want_io = tuple(getattr(ssl, name) for name in ('SSLWantReadError', 'SSLWantWriteError')
+                                      if hasattr(ssl, name))
+                # not every port with SSLContext can resume sessions
+                self._ssl_resume = hasattr(ssl, 'SSLSession')
+
+    def _connect(self):
+        stats = self.stats
+        stats['connects'] += 1
+        start = time.ticks_ms()
+        if self._ssl:
+            self._tls_setup()
+        if self._ssl and self._ssl_ctx is None:
+            # the handshake happens inside connect(), so both times are the same
+            ssl = self._ssl_mod
+            ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_SEC)
+            self.conn = ssl.wrap_socket(ss, cert_reqs=ssl.CERT_REQUIRED, ca_certs=self._ca_certs)
+            self.conn.connect(socket.getaddrinfo(self._server, self._port)[0][4])
+            stats['connect_ms'] = stats['tls_ms'] = time.ticks_diff(start, time.ticks_ms())
+            return
+        self.conn = socket.socket()
+        self.conn.connect(socket.getaddrinfo(self._server, self._port)[0][4])
+        tcp_done = time.ticks_ms()
+        stats['connect_ms'] = time.ticks_diff(start, tcp_done)
+        if self._ssl:
+            if self._ssl_resume:
+                self.conn = self._ssl_ctx.wrap_socket(self.conn, server_hostname=self._server,
+                                                      session=self._ssl_session)
+            else:
+                self.conn = self._ssl_ctx.wrap_socket(self.conn, server_hostname=self._server)
+            stats['tls_ms'] = time.ticks_diff(tcp_done, time.ticks_ms())
+            if self._ssl_resume and self.conn.session_reused:
+                stats['tls_resumed'] += 1
+
+    def _reply(self, data):
+        if not self._bulk:
+            self._send(data)
+            return
+        # collect the replies of one rx burst, they go out together once
+        # there's nothing more to read
+        if self._batch_len + len(data) > len(self._batch_buf):
+            self._flush_replies()
+        end = self._batch_len + len(data)
+        self._batch_buf[self._batch_len:end] = data
+        self._batch_len = end
+        self._batch_msgs += 1
+
+    def _flush_replies(self):
+        if self._batch_len:
+            self._send(memoryview(self._batch_buf)[:self._batch_len])
+            # the tx budget is per message
+            self._tx_count += self._batch_msgs - 1
+            self._batch_len = 0
+            self._batch_msgs = 0
+
     def _close(self):
-        self.conn.close()
+        self._batch_len = 0
+        self._batch_msgs = 0
+        self._poller = None
+        self._rx_closed = False
+        self._rx_data = b''
+        # keep the TLS session around so that the next handshake can resume it
+        session = getattr(self.conn, 'session', None) if self._ssl_resume else None
+        if session:
+            self._ssl_session = session
+        # None when the first connect failed before creating the socket
+        if self.conn:
+            self.conn.close()
+        self._save_state(True)
+        if self._cap:
+            self._cap.flush()
         self.state = DISCONNECTED
         time.sleep(RECONNECT_DELAY)
 
     def _server_alive(self):
-        c_time = int(time.time())
-        if self._m_time != c_time:
-            self._m_time = c_time
+        c_millis = time.ticks_ms()
+        if time.ticks_diff(self._m_time, c_millis) >= 1000:
+            self._m_time = c_millis
             self._tx_count = 0
             if self._wdt:
                 self._wdt.feed()
-            if self._last_hb_id != 0 and c_time - self._hb_time >= MAX_SOCK_TO:
+            self._save_state()
+            stats = self.stats
+            if self._last_hb_id != 0 and time.ticks_diff(self._hb_time, c_millis) >= stats['hb_timeout']:
+                stats['hb_timeouts'] += 1
                 return False
-            if c_time - self._hb_time >= HB_PERIOD and self.state == AUTHENTICATED:
-                self._hb_time = c_time
-                self._last_hb_id = self._new_msg_id()
-                self._send(struct.pack(HDR_FMT, MSG_PING, self._last_hb_id, 0), True)
+            if time.ticks_diff(self._hb_time, c_millis) >= HB_PERIOD * 1000 and self.state == AUTHENTICATED:
+                self._hb_time = c_millis
+                # data in both directions during the last period proves the
+                # link is alive, no need for a keepalive
+                if self._hb_skips < HB_MAX_SKIP and time.ticks_diff(self._rx_time, c_millis) < HB_PERIOD * 1000 and \
+                   time.ticks_diff(self._tx_time, c_millis) < HB_PERIOD * 1000:
+                    self._hb_skips += 1
+                    stats['pings_skipped'] += 1
+                else:
+                    self._hb_skips = 0
+                    stats['pings'] += 1
+                    self._last_hb_id = self._new_msg_id()
+                    self._send(self._format_hdr(MSG_PING, self._last_hb_id, 0), True)
         return True
 
+    def _hb_ack(self):
+        # the server answered the ping, adapt the timeout to the rtt like
+        # TCP does (srtt + 4 * rttvar, in 1/8 and 1/4 fixed point)
+        rtt = time.ticks_diff(self._hb_time, time.ticks_ms())
+        self._last_hb_id = 0
+        stats = self.stats
+        if not self._rtt_count or rtt < stats['rtt_min']:
+            stats['rtt_min'] = rtt
+        if rtt > stats['rtt_max']:
+            stats['rtt_max'] = rtt
+        self._rtt_sum += rtt
+        self._rtt_count += 1
+        stats['rtt_avg'] = self._rtt_sum // self._rtt_count
+        if not self._srtt:
+            self._srtt = rtt << 3
+            self._rttvar = rtt << 1
+        else:
+            err = rtt - (self._srtt >> 3)
+            self._srtt += err
+            self._rttvar += abs(err) - (self._rttvar >> 2)
+        timeout = (self._srtt >> 3) + self._rttvar
+        stats['hb_timeout'] = min(max(timeout, HB_MIN_TO), MAX_SOCK_TO * 1000)
+
+    def link_stats(self):
+        """
+        Heartbeat round trip times in ms as (min, avg, max) and the current
+        timeout. A slow link shows growing rtts, a dead server timeouts.
+        """
+        stats = self.stats
+        return (stats['rtt_min'], stats['rtt_avg'], stats['rtt_max']), stats['hb_timeout']
+
+    def _rx_pending(self):
+        # a partial frame can't be handled before more data comes, only a
+        # whole header or data buffered in the TLS layer is worth not sleeping
+        pending = getattr(self.conn, 'pending', None)
+        return len(self._rx_data) >= HDR_LEN or (pending and pending())
+
+    def _idle(self):
+        # sleep until the next deadline, which is either the user task, a
+        # sampler burst, a terminal flush or the once per second housekeeping
+        # in _server_alive (tx budget, wdt and heartbeat). Incoming data ends
+        # the wait right away
+        c_millis = time.ticks_ms()
+        timeout = 1000 - time.ticks_diff(self._m_time, c_millis)
+        if self._task:
+            t_timeout = self._task_period - time.ticks_diff(self._task_millis, c_millis)
+            if t_timeout < timeout:
+                timeout = t_timeout
+        sampler = self._sampler
+        if sampler:
+            t_timeout = sampler.period - time.ticks_diff(sampler.time, c_millis)
+            if t_timeout < timeout:
+                timeout = t_timeout
+        for term in self._terms:
+            t_timeout = term.timeout(c_millis)
+            if t_timeout is not None and t_timeout < timeout:
+                timeout = t_timeout
+        if timeout <= 0 or self._rx_pending():
+            return
+        # nothing is being received or sent right now, a good moment for
+        # the idle task (garbage collection) if it fits before the deadline
+        if self._idle_task and self._idle_task(timeout):
+            now = time.ticks_ms()
+            timeout -= time.ticks_diff(c_millis, now)
+            c_millis = now
+            if timeout <= 0:
+                return
+        stats = self.stats
+        stats['busy_ms'] += time.ticks_diff(self._wake_time, c_millis)
+        if self._poller:
+            self._poller.poll(timeout)
+        else:
+            sleep_from_until(c_millis, min(timeout, IDLE_TIME_MS))
+        self._wake_time = time.ticks_ms()
+        stats['idle_ms'] += time.ticks_diff(c_millis, self._wake_time)
+        stats['wakeups'] += 1
+
+    def idle_ratio(self):
+        """
+        Percentage of the connected time spent sleeping.
+        """
+        total = self.stats['idle_ms'] + self.stats['busy_ms']
+        return self.stats['idle_ms'] * 100 // total if total else 0
+
     def _run_task(self):
         if self._task:
             c_millis = time.ticks_ms()
-            if c_millis - self._task_millis >= self._task_period:
+            if time.ticks_diff(self._task_millis, c_millis) >= self._task_period:
                 self._task_millis += self._task_period
-                self._task()
+                try:
+                    self._task()
+                except MemoryError as e:
+                    self._out_of_memory(e)
+        if self._sampler:
+            # keeps the analog values of the 'ar' reads fresh, whether the
+            # user task runs the sampler as well or not
+            self._sampler.run()
 
     def repl(self, pin):
         repl = Terminal(self, pin)
         self.add_virtual_pin(pin, repl.virtual_read, repl.virtual_write)
+        self._terms.append(repl)
         return repl
 
     def notify(self, msg):
@@ -292,13 +861,26 @@ class Blynk:
         if self.state == AUTHENTICATED:
             self._send(self._format_msg(MSG_EMAIL, to, subject, body))
 
-    def virtual_write(self, pin, val):
-        if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_HW, 'vw', pin, val))
+    def virtual_write(self, pin, *vals):
+        # several values go out as one message, for the multi value widgets
+        online = self.state == AUTHENTICATED
+        if online or pin in self._state_pins:
+            data = self._format_msg(MSG_HW, 'vw', pin, *vals)
+            if pin in self._state_pins:
+                self._keep_state(pin, bytes(data[HDR_LEN:]), not online)
+            if online:
+                self._send(data)
 
-    def add_virtual_pin(self, pin, read=None, write=None):
+    def add_virtual_pin(self, pin, read=None, write=None, cache=False):
+        """
+        With cache=True the last value written to the pin is kept (and saved
+        to state_file), replayed into the write handler at startup and only
+        requested from the server after a reconnect if it isn't known.
+        """
         if isinstance(pin, int) and pin in range(0, MAX_VIRTUAL_PINS):
             self._vr_pins[pin] = VrPin(read, write)
+            if cache:
+                self._state_pins.add(pin)
         else:
             raise ValueError('')
 
@@ -308,6 +890,37 @@ class Blynk:
         self._task = task
         self._task_period = ms_period
 
+    def set_idle_task(self, task):
+        """
+        task(gap_ms) is called when the loop is about to sleep for gap_ms,
+        it returns True if it used some of that time.
+        """
+        self._idle_task = task
+
+    def set_memory_handler(self, handler):
+        """
+        handler() is called when a pin handler or the user task runs out of
+        memory. The session goes on, without a handler the MemoryError
+        leaves run().
+        """
+        self._mem_handler = handler
+
+    def _sv_begin(self):
+        if self._sv_task is not None:
+            self._wdt.begin(self._sv_task, True)
+
+    def _sv_end(self, done):
+        # the marker of a failed attempt stays for the next one, an outage
+        # writes it to flash only once
+        if self._sv_task is not None:
+            self._wdt.end(self._sv_task, done)
+
+    def _out_of_memory(self, e):
+        if not self._mem_handler:
+            raise e
+        self.stats['mem_errors'] += 1
+        self._mem_handler()
+
     def connect(self):
         self._do_connect = True
 
@@ -319,15 +932,28 @@ class Blynk:
         self._task_millis = self._start_time
         self._hw_pins = {}
         self._rx_data = b''
+        self._rx_closed = False
         self._msg_id = 1
         self._pins_configured = False
         self._timeout = None
         self._tx_count = 0
-        self._m_time = 0
+        # the housekeeping in _server_alive is due right away
+        self._m_time = self._start_time - 1000
         self.state = DISCONNECTED
+        if self.conn:
+            # an exception ended the last run() while connected, don't leak its socket
+            self.conn.close()
+            self.conn = None
+        if self._state_file and not self._state_loaded:
+            self._load_state()
 
-        if self._wdt:
+        # wdt=True creates the watchdog here, any object with a feed() method
+        # (like a supervisor that owns the watchdog) is used as it is
+        if self._wdt is True:
             self._wdt = machine.WDT(timeout=WDT_TO)
+        # a supervisor watches the connect and the login as a task of its own
+        if self._sv_task is None and hasattr(self._wdt, 'register'):
+            self._sv_task = self._wdt.register('connect', CONNECT_STALL, False)
 
         while True:
             while self.state != AUTHENTICATED:
@@ -335,39 +961,48 @@ class Blynk:
                 if self._wdt:
                     self._wdt.feed()
                 if self._do_connect:
+                    # nothing feeds the watchdog until the login is answered
+                    self._sv_begin()
                     try:
                         self.state = CONNECTING
-                        if self._ssl:
-                            import ssl
-                            ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_SEC)
-                            self.conn = ssl.wrap_socket(ss, cert_reqs=ssl.CERT_REQUIRED, ca_certs='/flash/cert/ca.pem')
-                        else:
-                            self.conn = socket.socket()
-                        self.conn.connect(socket.getaddrinfo(self._server, self._port)[0][4])
+                        self._connect()
                     except:
+                        self._sv_end(False)
+                        self.stats['conn_fails'] += 1
                         self._close()
                         continue
+                    if self._cap:
+                        self._capture(CAP_CONNECT, b'')
 
                     self.state = AUTHENTICATING
-                    hdr = struct.pack(HDR_FMT, MSG_LOGIN, self._new_msg_id(), len(self._token))
-                    self._send(hdr + self._token, True)
+                    self._send(self._format_msg(MSG_LOGIN, self._token), True)
                     data = self._recv(HDR_LEN, timeout=MAX_SOCK_TO)
                     if not data:
+                        self._sv_end(False)
                         self._close()
                         continue
 
                     msg_type, msg_id, status = struct.unpack(HDR_FMT, data)
                     if status != STA_SUCCESS or msg_id == 0:
+                        self._sv_end(False)
                         self._close()
                         continue
+                    self._sv_end(True)
 
                     self.state = AUTHENTICATED
                 else:
                     self._start_time = sleep_from_until(self._start_time, TASK_PERIOD_RES)
 
-            self._hb_time = 0
+            self._hb_time = time.ticks_ms() - HB_PERIOD * 1000
             self._last_hb_id = 0
+            self._hb_skips = 0
             self._tx_count = 0
+            self._rx_time = self._tx_time = self._hb_time
+            self._sync_state()
+            self._wake_time = time.ticks_ms()
+            if select:
+                self._poller = select.poll()
+                self._poller.register(self.conn, select.POLLIN)
             while self._do_connect:
                 data = self._recv(HDR_LEN, NON_BLK_SOCK)
                 if data:
@@ -377,22 +1012,28 @@ class Blynk:
                         break
                     if msg_type == MSG_RSP:
                         if msg_id == self._last_hb_id:
-                            self._last_hb_id = 0
+                            self._hb_ack()
                     elif msg_type == MSG_PING:
-                        self._send(struct.pack(HDR_FMT, MSG_RSP, msg_id, STA_SUCCESS), True)
+                        self._send(self._format_hdr(MSG_RSP, msg_id, STA_SUCCESS), True)
                     elif msg_type == MSG_HW or msg_type == MSG_BRIDGE:
                         data = self._recv(msg_len, MIN_SOCK_TO)
                         if data:
-                            self._handle_hw(data)
+                            try:
+                                self._handle_hw(data)
+                            except MemoryError as e:
+                                self._out_of_memory(e)
                     else:
                         self._close()
                         break
                 else:
-                    self._start_time = sleep_from_until(self._start_time, IDLE_TIME_MS)
-                if not self._server_alive():
+                    self._flush_replies()
+                    self._idle()
+                if self._rx_closed or not self._server_alive():
                     self._close()
                     break
                 self._run_task()
+                for term in self._terms:
+                    term.poll()
 
             if not self._do_connect:
                 self._close()
@@ -2,8 +2,10 @@
 
 # Simple driver for the BH1750FVI digital light sensor
 
+MEASUREMENT_TIME = const(120)
+
 class BH1750FVI:
-    MEASUREMENT_TIME = const(120)
+    __slots__ = ('i2c', 'period', 'addr', 'time', 'value')
 
     def __init__(self, i2c, addr=0x23, period=150):
         self.i2c = i2c
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Small publish/subscribe layer for the sensor pipeline. Drivers publish
+# their readings on a topic and the subscribers of that topic only run
+# when the value actually changed. Rollup condenses a sample stream into
+# per window statistics.
+
+import time
+
+class EventBus:
+    __slots__ = ('_subs', '_values', 'published', 'delivered', 'polled', '_stats_time', '_stats_delivered',
+                 '_stats_polled')
+
+    def __init__(self):
+        self._subs = {}
+        self._values = {}
+        self.published = 0
+        self.delivered = 0
+        # the callbacks a design that runs every consumer on every reading would make
+        self.polled = 0
+        self._stats_time = time.ticks_ms()
+        self._stats_delivered = 0
+        self._stats_polled = 0
+
+    def subscribe(self, topic, callback):
+        if topic in self._subs:
+            self._subs[topic].append(callback)
+        else:
+            self._subs[topic] = [callback]
+
+    def publish(self, topic, value):
+        # returns True if the value changed and the subscribers were called
+        subs = self._subs.get(topic, ())
+        self.published += 1
+        self.polled += len(subs)
+        if topic in self._values and self._values[topic] == value:
+            return False
+        self._values[topic] = value
+        for callback in subs:
+            callback(value)
+        self.delivered += len(subs)
+        return True
+
+    def value(self, topic, default=None):
+        return self._values.get(topic, default)
+
+    def stats(self):
+        # returns (callbacks per second, callbacks saved per second) since the last call
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(self._stats_time, now)
+        if elapsed <= 0:
+            return (0, 0)
+        delivered = self.delivered - self._stats_delivered
+        saved = self.polled - self._stats_polled - delivered
+        self._stats_time = now
+        self._stats_delivered = self.delivered
+        self._stats_polled = self.polled
+        return (delivered * 1000 // elapsed, saved * 1000 // elapsed)
+
+class Rollup:
+    # min/max/mean/count of an integer stream over fixed time windows, kept
+    # as running aggregates so the memory doesn't grow with the samples
+
+    __slots__ = ('window', 'start', 'min', 'max', 'sum', 'count')
+
+    def __init__(self, window):
+        self.window = window
+        self.start = time.ticks_ms()
+        self.count = 0
+
+    def add(self, value):
+        # returns (min, max, mean, count) of the previous window when this
+        # sample starts a new one, None otherwise
+        now = time.ticks_ms()
+        result = None
+        if time.ticks_diff(self.start, now) >= self.window:
+            if self.count:
+                result = (self.min, self.max, self.sum // self.count, self.count)
+            self.start = now
+            self.count = 0
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+            self.sum += value
+            self.count += 1
+        else:
+            self.min = self.max = self.sum = value
+            self.count = 1
+        return result
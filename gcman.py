@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Garbage collection manager. Collects in the idle gaps of the main loop
+# instead of letting the allocator do it in the middle of a transfer,
+# keeps gc.threshold in step with the free heap, tracks the free memory
+# and the largest free block, and switches to a degraded mode (the
+# application sheds the optional work) before the heap runs out.
+
+import gc
+import time
+
+GC_MIN_GAP = const(20)          # ms of idle time needed to collect
+GC_MAX_PERIOD = const(5000)     # collect at least this often
+GC_PROBE_PERIOD = const(10000)  # how often to measure the largest free block
+GC_PROBE_BUDGET = const(50)     # ms the measurement may take outside of an idle gap
+GC_PROBE_MIN = const(10)        # skip the measurement with less time left in the gap
+GC_LOW_FREE = const(8192)       # enter the degraded mode below this...
+GC_OK_FREE = const(12288)       # ...and leave it above this
+GC_MIN_BLOCK = const(1024)      # degraded as well if no block of this size is left
+
+class GCManager:
+    __slots__ = ('bus', 'free', 'largest', 'min_free', 'min_largest', 'threshold', 'degraded', 'collects',
+                 'collect_ms', 'emergencies', 'time', 'probe_time')
+
+    def __init__(self, bus=None):
+        self.bus = bus
+        self.free = gc.mem_free()
+        self.largest = self.free
+        self.min_free = self.free
+        self.min_largest = self.free
+        self.threshold = -1
+        self.degraded = False
+        self.collects = 0
+        self.collect_ms = 0
+        self.emergencies = 0
+        self.time = time.ticks_ms()
+        self.probe_time = self.time
+        self.collect()
+
+    def idle(self, gap):
+        """
+        Called with the ms left before the next deadline. Collects when the
+        gap is long enough and half of the threshold has been allocated
+        since the last collection. Returns True if it did.
+        """
+        if gap < GC_MIN_GAP:
+            return False
+        if self.free - gc.mem_free() < self.threshold // 2 and \
+           time.ticks_diff(self.time, time.ticks_ms()) < GC_MAX_PERIOD:
+            return False
+        self.collect(gap)
+        return True
+
+    def collect(self, gap=GC_PROBE_BUDGET):
+        # gap is the time available, the largest block measurement gets
+        # what the collection left of it
+        start = time.ticks_ms()
+        gc.collect()
+        self.time = time.ticks_ms()
+        self.collects += 1
+        self.collect_ms += time.ticks_diff(start, self.time)
+        self.free = free = gc.mem_free()
+        if free < self.min_free:
+            self.min_free = free
+        # let the automatic collection kick in only after a quarter of the
+        # free heap was used, the planned ones normally come much earlier
+        threshold = free // 4
+        if threshold != self.threshold and hasattr(gc, 'threshold'):
+            gc.threshold(threshold)
+        self.threshold = threshold
+        budget = gap - time.ticks_diff(start, self.time)
+        if time.ticks_diff(self.probe_time, self.time) >= GC_PROBE_PERIOD and budget >= GC_PROBE_MIN:
+            self.probe_time = self.time
+            largest = self._largest_block(free, budget)
+            if largest:
+                self.largest = largest
+            if self.largest < self.min_largest:
+                self.min_largest = self.largest
+            if self.bus:
+                self.bus.publish('heap', (free, self.largest))
+        self._check()
+
+    def _largest_block(self, free, budget):
+        # there's no API for it, so look for the biggest allocation that
+        # succeeds. Only done right after a collection and at most every
+        # GC_PROBE_PERIOD, the blocks are freed by the next collection.
+        # It's expensive: the search takes about 10 probes, and before a
+        # probe fails the allocator runs a full collection of its own. So
+        # the search stops after budget ms, leaving a lower bound (0 if no
+        # probe succeeded yet)
+        start = time.ticks_ms()
+        low = 0
+        high = free
+        while high - low > 64 and time.ticks_diff(start, time.ticks_ms()) < budget:
+            size = (low + high) // 2
+            try:
+                block = bytearray(size)
+                low = size
+            except MemoryError:
+                high = size
+            block = None
+        return low
+
+    def _check(self):
+        if self.degraded:
+            degraded = self.free < GC_OK_FREE
+        else:
+            degraded = self.free < GC_LOW_FREE or self.largest < GC_MIN_BLOCK
+        if degraded != self.degraded:
+            self.degraded = degraded
+            if self.bus:
+                self.bus.publish('degraded', degraded)
+
+    def emergency(self):
+        # a MemoryError made it to the main loop, free what we can and
+        # shed the optional work right away
+        self.emergencies += 1
+        self.probe_time = self.time - GC_PROBE_PERIOD
+        self.collect()
+        if not self.degraded:
+            self.degraded = True
+            if self.bus:
+                self.bus.publish('degraded', True)
+
+    def stats(self):
+        # (free, largest free block, lowest free, smallest largest block, collections, ms spent collecting)
+        return (self.free, self.largest, self.min_free, self.min_largest, self.collects, self.collect_ms)
@@ -6,6 +6,8 @@
 # pressure sensor, and a solid state relay which controlls 
 # a light bulb and a BH1750FVI digital light sensor.
 
+import time
+import array
 import config
 import onewire
 import BlynkLib
@@ -14,19 +16,43 @@ from machine import Pin
 from machine import RTC
 from machine import I2C
 from machine import WDT
-from machine import ADC
 from network import WLAN
 from bh1750fvi import BH1750FVI
 from ms5637 import MS5637
 from ws2812 import WS2812
+from events import EventBus, Rollup
+from supervisor import Supervisor
+from gcman import GCManager
+from sampler import ADCSampler
 
 WIFI_SSID  = config.ssid
 WIFI_AUTH  = config.auth
 BLYNK_AUTH = config.token
+BLYNK_STATE = '/flash/blynk_state.bin' # the handler pin values survive reboots and reconnects
 
 MAIN_TASK_PERIOD = const(50)
 WDT_TIMEOUT = const(15000)
+MAIN_TASK_STALL = const(10000) # the main task must run at least every 10 seconds
 LEDS_MAX_DELAY = const(10)
+LEDS_FPS = const(50)
+
+SW_MAX_UPDATE_TIME = const(1000) # at least one update every second
+SW_DEBOUNCE_TIME = const(20)
+SW_RING_LEN = const(16)
+
+DS18B20_RESOLUTION = const(12) # 0.0625 C in 750 ms, the dashboard shows hundredths
+BH1750FVI_ADDR = const(35)
+MS5637_ADDR = const(118)
+MAX_LUX_UPDATE_TIME = const(1000)
+LIGHT_DEBOUNCE_TIME = const(2500)
+LIGHT_HOLD_TIME = const(250)
+
+# per window min/max/mean/count of the raw sensor samples: stream, virtual
+# pin and window in ms. Temperature in 1/100 C, pressure in Pa, lux and
+# battery in mV
+ROLLUP_WINDOW = const(60000)
+ROLLUPS = (('temp', 14, ROLLUP_WINDOW), ('bar', 15, ROLLUP_WINDOW), ('lux', 16, ROLLUP_WINDOW),
+           ('volt', 17, ROLLUP_WINDOW))
 
 def connect_to_wlan(wlan):
     # try connecting to wifi until succeeding
@@ -39,19 +65,27 @@ def connect_to_wlan(wlan):
         except OSError:
             pass
 
+def centi_str(val):
+    # hundredths as a decimal string, -5 is '-00.05' and not '-1.95'
+    sign = '-' if val < 0 else ''
+    val = abs(val)
+    return '{}{:02d}.{:02d}'.format(sign, val // 100, val % 100)
+
 class BatteryMonitor:
     levels = ((4115, 100), (4050, 95), (3990, 90), (3935, 85),
               (3875, 75), (3825, 70), (3785, 60), (3750, 50),
               (3700, 40), (3675, 30), (3650, 25), (3600, 20),
               (3500, 10), (3490, 5), (3400, 3), (3300, 1), (0, 0))
 
-    def __init__(self, pin):
-        adc = ADC(bits=12)
-        self.apin = adc.channel(pin=pin)
-        self.values = [0 for i in range(5)]
+    __slots__ = ('sampler', 'idx', 'bursts', 'volt', 'chrg')
+
+    def __init__(self, sampler, pin):
+        # the battery voltage comes filtered and oversampled from the sampler
+        self.sampler = sampler
+        self.idx = sampler.add(pin)
+        self.bursts = 0
         self.volt = 4200
         self.chrg = 100
-        self.idx = 0
 
     def _charge(self):
         for i in range(len(self.levels)):
@@ -63,16 +97,18 @@ class BatteryMonitor:
         return self.chrg
 
     def read(self):
-        # compensate for the resistors value and tolerance
-        self.values[self.idx] = self.apin() * 117 // 100
-        self.idx = (self.idx + 1) % len(self.values)
-        if self.idx == 0: # the list is full
-            self.volt = sum(self.values) // len(self.values)
-            return self._charge()
-        else:
+        # returns the charge when the sampler has a new value, None otherwise
+        bursts = self.sampler.bursts[self.idx]
+        if bursts == self.bursts:
             return None
+        self.bursts = bursts
+        # compensate for the resistors value and tolerance, from 14 bits
+        self.volt = self.sampler.value(self.idx) * 117 // 400
+        return self._charge()
 
 class VirtualSw:
+    __slots__ = ('pin', 'vsw_value', 'pin_value')
+
     def __init__(self, pin):
         self.pin = Pin(pin, Pin.OUT, pull=Pin.PULL_DOWN, value=0)
         self.vsw_value = 0
@@ -93,55 +129,147 @@ class VirtualSw:
         self._shift(self.vsw_value)
 
 class HwSw:
-    SW_MAX_UPDATE_TIME = const(1000) # at least one update every second 
+    # push button on a GPIO. With irq=True the edges are timestamped by the
+    # pin interrupt into a ring and debounced in check(), so short presses
+    # between two ticks aren't lost. resend is the period of the refresh
+    # of the state on the server, 0 disables it
 
-    def __init__(self, blynk, hw_pin, v_pin, period):
+    __slots__ = ('blynk', 'sw', 'v_pin', 'value', 'period', 'time', 'bus', 'topic', 'resend', 'irq',
+                 'ring', 'levels', 'head', 'tail', 'last_time', 'last_level', 'unconfirmed')
+
+    def __init__(self, blynk, hw_pin, v_pin, period, bus=None, topic=None, irq=False, resend=SW_MAX_UPDATE_TIME):
         self.blynk = blynk
         self.sw = Pin(hw_pin, Pin.IN, pull=Pin.PULL_UP)
         self.v_pin = v_pin
         self.value = self.sw()
         self.period = period
         self.time = 0
+        self.bus = bus
+        self.topic = topic
+        self.resend = resend
+        self.irq = irq
+        self.ring = array.array('i', (0 for i in range(SW_RING_LEN)))
+        self.levels = bytearray(SW_RING_LEN)
+        self.head = 0
+        self.tail = 0
+        self.last_time = 0
+        self.last_level = self.value
+        self.unconfirmed = False
+        if bus:
+            bus.publish(topic, self.value)
+        if irq:
+            self.sw.irq(trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, handler=self._edge)
+
+    def _edge(self, pin):
+        # pin interrupt, no allocations allowed in here. When the ring is
+        # full the newest edges are dropped
+        head = self.head
+        nxt = (head + 1) % SW_RING_LEN
+        if nxt != self.tail:
+            self.ring[head] = time.ticks_ms()
+            self.levels[head] = pin()
+            self.head = nxt
 
     def update(self):
         self.time = 0
         self.blynk.virtual_write(self.v_pin, not self.value)
 
-    def check(self):
-        value = self.sw()
+    def _confirm(self, value):
         if value != self.value:
             self.value = value
             self.update()
+            if self.bus:
+                self.bus.publish(self.topic, value)
             return not value
+        return False
+
+    def _debounce(self):
+        # a level counts once it was stable for SW_DEBOUNCE_TIME, either
+        # until the next edge or until now
+        pressed = False
+        while self.tail != self.head:
+            edge_time = self.ring[self.tail]
+            if self.unconfirmed and time.ticks_diff(self.last_time, edge_time) >= SW_DEBOUNCE_TIME:
+                pressed = self._confirm(self.last_level) or pressed
+            self.last_time = edge_time
+            self.last_level = self.levels[self.tail]
+            self.unconfirmed = True
+            self.tail = (self.tail + 1) % SW_RING_LEN
+        if self.unconfirmed and time.ticks_diff(self.last_time, time.ticks_ms()) >= SW_DEBOUNCE_TIME:
+            self.unconfirmed = False
+            pressed = self._confirm(self.last_level) or pressed
+        return pressed
+
+    def check(self):
+        if self.irq:
+            changed = self.head != self.tail or self.unconfirmed
+            pressed = self._debounce()
         else:
+            value = self.sw()
+            changed = value != self.value
+            pressed = self._confirm(value)
+        if not changed and self.resend:
             self.time += self.period
-            if self.time > SW_MAX_UPDATE_TIME:
+            if self.time > self.resend:
                 self.update()
-        return False
+        return pressed
 
 class LedShow:
     #########    BLUE        GREEN        RED        WHITE         OFF
     colors = ((0, 0, 48), (0, 48, 0), (48, 0, 0), (16, 16, 16), (0, 0, 0))
 
-    def __init__(self, period, nleds=12):
+    __slots__ = ('nleds', 'period', 'delay', 'time', 'idx', 'offset', 'data', 'chain', 'fps', 'paused')
+
+    def __init__(self, period, nleds=12, fps=0):
         self.nleds = nleds
         self.period = period
         self.delay = (LEDS_MAX_DELAY + 1) * period
-        self.time = 0
+        self.time = time.ticks_ms()
         self.idx = 0
+        self.offset = 0
+        # the RGB pattern, rotated by offset when shown
+        self.data = bytearray(nleds * 3)
         self.chain = WS2812(nleds)
+        self.fps = fps
+        self.paused = False
+        if fps: # refresh from a timer, sweep only renders the frames
+            self.chain.start(fps)
         self._shift(self.idx)
 
     def _shift(self, idx):
-        self.data = [self.colors[idx] if n < (self.nleds - self.nleds // 3) else (0, 0 ,0) for n in range(self.nleds)]
-        self.chain.show(self.data)
+        color = self.colors[idx]
+        lit = (self.nleds - self.nleds // 3) * 3
+        data = self.data
+        for n in range(len(data)):
+            data[n] = color[n % 3] if n < lit else 0
+        self.chain.show(data, self.offset)
 
     def sweep(self):
-        self.time += self.period
-        if self.time >= self.delay:
-            self.time = 0
-            self.data = self.data[1:] + self.data[0:1]
-            self.chain.show(self.data)
+        # take all the steps that are due, so that a late call (the loop was
+        # busy reconnecting) doesn't slow the animation down
+        if self.paused:
+            return
+        steps = time.ticks_diff(self.time, time.ticks_ms()) // self.delay
+        if steps:
+            self.time += steps * self.delay
+            self.offset = (self.offset + steps) % self.nleds
+            self.chain.show(self.data, self.offset)
+
+    def pause(self, paused):
+        # freezes the animation and its refresh timer, the leds keep the last frame
+        if paused != self.paused:
+            self.paused = paused
+            if self.fps:
+                if paused:
+                    self.chain.stop()
+                else:
+                    self.chain.start(self.fps)
+            if not paused:
+                self.time = time.ticks_ms()
+
+    def stats(self):
+        # (frames per second, frames pushed, frames dropped) of the refresh timer
+        return self.chain.stats()
 
     def shift_handler(self, value):
         if int(value):
@@ -149,133 +277,210 @@ class LedShow:
             self._shift(self.idx)
 
     def delay_handler(self, value):
-        self.delay = ((LEDS_MAX_DELAY + 1) - int(value)) * self.period
+        # at least one period, the sweep divides by it
+        self.delay = max(((LEDS_MAX_DELAY + 1) - int(value)) * self.period, self.period)
+
+class LightController:
+    # switches the light on when it gets dark and off again when there's
+    # enough daylight, as long as the light switch (V7) is on. Runs on lux
+    # and relay changes, poll() only has work when a timer is pending
+
+    __slots__ = ('relay', 'lux', 'lsw', 'rly', 'ld_start', 'lh_start', 'timer', 'wait')
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.lux = 0
+        self.lsw = 0
+        self.rly = 0
+        self.ld_start = time.ticks_ms()
+        self.lh_start = None
+        self.timer = 0
+        self.wait = None # ms from timer until the next check, None if no timer
+
+    def lux_handler(self, lux):
+        self.lux = lux
+        self._check(time.ticks_ms())
+
+    def relay_handler(self, state):
+        lsw, self.rly = state
+        now = time.ticks_ms()
+        if self.lsw != lsw: # reset the debounce time
+            self.lsw = lsw
+            self.ld_start = now
+        self._check(now)
+
+    def poll(self):
+        if self.wait is not None:
+            now = time.ticks_ms()
+            if time.ticks_diff(self.timer, now) >= self.wait:
+                self._check(now)
+
+    def _check(self, now):
+        self.wait = None
+        if not self.lsw: # is the light switch on?
+            return
+        elapsed = time.ticks_diff(self.ld_start, now)
+        if elapsed < LIGHT_DEBOUNCE_TIME:
+            self.timer = now
+            self.wait = LIGHT_DEBOUNCE_TIME - elapsed
+            return
+        # too bright with the relay on or too dark with it off
+        if (self.rly and self.lux > 250) or (not self.rly and self.lux < 220):
+            if self.lh_start is None:
+                self.lh_start = now
+            elapsed = time.ticks_diff(self.lh_start, now)
+            if elapsed > LIGHT_HOLD_TIME:
+                self.rly = 0 if self.rly else 1
+                self.relay(self.rly) # turn the light off or on
+                self.ld_start = now
+                self.lh_start = None
+                self.timer = now
+                self.wait = LIGHT_DEBOUNCE_TIME
+            else:
+                self.timer = now
+                self.wait = LIGHT_HOLD_TIME + 1 - elapsed
+        else:
+            self.lh_start = None
 
 class MainTask:
-    BH1750FVI_ADDR = const(35)
-    MS5637_ADDR = const(118)
-    MAX_LUX_UPDATE_TIME = const(1000)
-    LIGHT_DEBOUNCE_TIME = const(2500)
-    LIGHT_HOLD_TIME = const(250)
+    __slots__ = ('blynk', 'bus', 'ds18b20', 'bh1750fvi', 'ms5637', 'sw1', 'sw2', 'ledshow', 'relay', 'light',
+                 'email', 'notify', 'battery', 'supervisor', 'sv_task', 'period', 'ds_state', 'ds_start', 'ds_wait', 'lux_time', 'lux_turn',
+                 'degraded', 'rollups', 'sampler')
 
-    def __init__(self, blynk, ow_pin, sw1_pin, sw2_pin, relay, email, notify, battery, wdt, nleds, period):
+    def __init__(self, blynk, ow_pin, sw1_pin, sw2_pin, relay, email, notify, battery, supervisor, nleds, period,
+                 rollups=ROLLUPS, sampler=None):
         self.blynk = blynk
-        self.ds18b20 = onewire.DS18X20(onewire.OneWire(Pin(ow_pin)))
+        self.bus = bus = EventBus()
+        # ow_pin can also be a list of pins, one OneWire bus on each
+        ow_pins = ow_pin if isinstance(ow_pin, (list, tuple)) else (ow_pin,)
+        self.ds18b20 = onewire.DS18X20([onewire.OneWire(Pin(pin)) for pin in ow_pins])
+        for rom in self.ds18b20.roms:
+            if rom[0] == 0x28:
+                self.ds18b20.set_resolution(DS18B20_RESOLUTION, rom)
         i2c = I2C(baudrate=100000, pins=('GP13', 'GP12'))
         self.bh1750fvi = BH1750FVI(i2c, BH1750FVI_ADDR, period)
         self.ms5637 = MS5637(i2c, MS5637_ADDR)
-        self.sw1 = HwSw(blynk, sw1_pin, 1, period) # registered on vpin 1
-        self.sw2 = HwSw(blynk, sw2_pin, 10, period) # registered on vpin 10
+        self.sw1 = HwSw(blynk, sw1_pin, 1, period, bus, 'sw1', irq=True) # registered on vpin 1
+        self.sw2 = HwSw(blynk, sw2_pin, 10, period, bus, 'sw2', irq=True) # registered on vpin 10
 
-        self.ledshow = LedShow(period, nleds)
+        self.ledshow = LedShow(period, nleds, LEDS_FPS)
         # register the ledshow color handler on V2
-        blynk.add_virtual_pin(2, write=self.ledshow.shift_handler)
+        blynk.add_virtual_pin(2, write=self.ledshow.shift_handler, cache=True)
         # register the ledshow delay handler on V9
-        blynk.add_virtual_pin(9, write=self.ledshow.delay_handler)
+        blynk.add_virtual_pin(9, write=self.ledshow.delay_handler, cache=True)
 
         self.relay = relay
+        self.light = LightController(relay)
         self.email = email
         self.notify = notify
         self.battery = battery
-        self.wdt = wdt
+        self.sampler = sampler
+        self.supervisor = supervisor
+        self.sv_task = supervisor.register('main', MAIN_TASK_STALL)
         self.period = period
         self.ds_state = 'CONV'
-        self.lux = 0
+        self.ds_start = 0
+        self.ds_wait = 0
         self.lux_time = 0
-        self.ld_time = 0
-        self.lh_time = 0
         self.lux_turn = False
-        self.day_night = ''
-        self.lsw = 0
-        self.leds_period = period
-        self.bar = 0
+        self.degraded = False
+        self.rollups = {}
+        for stream, v_pin, window in rollups:
+            self.rollups[stream] = (Rollup(window), v_pin)
+
+        # the Blynk publishers
+        bus.subscribe('temp', lambda tmp: blynk.virtual_write(3, centi_str(tmp)))
+        bus.subscribe('bar', lambda bar: blynk.virtual_write(4, '{}'.format(bar // 100)))
+        bus.subscribe('lux', lambda lux: blynk.virtual_write(8, lux))
+        bus.subscribe('day_night', lambda day_night: blynk.virtual_write(12, day_night))
+        bus.subscribe('charge', lambda charge: blynk.virtual_write(11, '{} %'.format(charge)))
+        # the push buttons are active low
+        bus.subscribe('sw1', lambda value: value or notify.send('You pressed the red button and I know it ;)'))
+        bus.subscribe('sw2', lambda value: value or email.send('[WiPy] IoT Demo', 'You pressed the green button and I know it ;)'))
+        # the day/night classifier and the automatic light control
+        bus.subscribe('lux', lambda lux: bus.publish('day_night', 'Day' if lux > 100 else 'Night'))
+        bus.subscribe('lux', self.light.lux_handler)
+        bus.subscribe('relay', self.light.relay_handler)
+        # heap metrics from the gc manager and the low memory mode
+        bus.subscribe('heap', lambda heap: blynk.virtual_write(13, '{} / {} kB'.format(heap[0] // 1024, heap[1] // 1024)))
+        bus.subscribe('degraded', self.degrade)
+
+    def _sample(self, stream, value):
+        # one multi value write (min, max, mean, count) per finished window
+        if stream in self.rollups:
+            rollup, v_pin = self.rollups[stream]
+            window = rollup.add(value)
+            if window:
+                self.blynk.virtual_write(v_pin, *window)
+
+    def degrade(self, degraded):
+        # with little memory left stop the led animation and the optional telemetry
+        self.degraded = degraded
+        self.ledshow.pause(degraded)
 
     def run(self):
-        # feed the watchdog
-        self.wdt.feed()
+        # the supervisor only feeds the watchdog while this keeps running
+        self.supervisor.begin(self.sv_task)
+        bus = self.bus
 
+        # all the probes of all the buses convert together, the reads are
+        # spread over the ticks once the conversion time is over
         if self.ds_state == 'CONV':
-            self.ds18b20.start_convertion(self.ds18b20.roms[0])
+            self.ds_start = time.ticks_ms()
+            self.ds_wait = self.ds18b20.start_sweep()
             self.ds_state = 'READ'
-        elif self.ds_state == 'READ':
-            tmp = self.ds18b20.read_temp_async(self.ds18b20.roms[0])
-            if tmp != None:
-                self.blynk.virtual_write(3, '{:02d}.{:02d}'.format(tmp // 100, tmp % 100))
+        elif self.ds_state == 'READ' and time.ticks_diff(self.ds_start, time.ticks_ms()) >= self.ds_wait:
+            if self.ds18b20.poll_sweep():
+                # the first probe is the one shown on the dashboard
+                tmp = self.ds18b20.temps[0]
+                self._sample('temp', tmp)
+                bus.publish('temp', tmp)
                 self.ds_state = 'CONV'
 
-        # read the debounced push button 1 state
-        if self.sw1.check():
-            self.notify.send('You pressed the red button and I know it ;)')
-
-        # check also push button 2
-        if self.sw2.check():
-            self.email.send('[WiPy] IoT Demo', 'You pressed the green button and I know it ;)')
+        # the push buttons publish their debounced state themselves
+        self.sw1.check()
+        self.sw2.check()
 
         # only check the Lux value on every other cycle
         if self.lux_turn:
             self.lux_turn = False
             lux = self.bh1750fvi.read()
-            if self.lux != lux:
-                self.lux = lux
-                self.blynk.virtual_write(8, self.lux)
-                if self.lux > 100:
-                    day_night = 'Day'
-                else:
-                    day_night = 'Night'
-                if self.day_night != day_night:
-                    self.day_night = day_night
-                    self.blynk.virtual_write(12, self.day_night)
-            else:
+            self._sample('lux', lux)
+            if not bus.publish('lux', lux) and not self.degraded:
                 self.lux_time += self.period
                 if self.lux_time >= MAX_LUX_UPDATE_TIME:
                     self.lux_time = 0
-                    self.blynk.virtual_write(8, self.lux)
-                    self.blynk.virtual_write(12, self.day_night)
+                    self.blynk.virtual_write(8, bus.value('lux'))
+                    self.blynk.virtual_write(12, bus.value('day_night'))
         else:
             self.lux_turn = True
 
         # keep the led show running
         self.ledshow.sweep()
 
-        # show the battery charge
-        charge = self.battery.read()
-        if charge != None:
-            self.blynk.virtual_write(11, '{} %'.format(charge)) # vpin 11
+        # the analog inputs are sampled in bursts, the readers get the filtered values
+        if self.sampler:
+            self.sampler.run()
 
-        # run the barometric sensor task
-        self.ms5637.run()
-        bar = self.ms5637.bar()
-        if self.bar != bar:
-            self.bar = bar
-            self.blynk.virtual_write(4, '{}'.format(bar // 100)) # vpin 4
+        if not self.degraded:
+            # show the battery charge
+            charge = self.battery.read()
+            if charge != None:
+                self._sample('volt', self.battery.volt)
+                bus.publish('charge', charge)
 
-        # now some logic to control the light automatically
-        lsw, rly = self.relay()
-        if self.lsw != lsw: # reset the debounce time
-            self.lsw = lsw
-            self.ld_time = 0
-        if lsw: # is the light switch on?
-            if self.ld_time < LIGHT_DEBOUNCE_TIME:
-                self.ld_time += self.period
-            else:
-                if rly: # if the relay is on
-                    if self.lux > 250:
-                        self.lh_time += self.period
-                        if self.lh_time > LIGHT_HOLD_TIME:
-                            self.relay(0) # turn the light off
-                            self.ld_time = 0
-                            self.lh_time = 0
-                    else:
-                        self.lh_time = 0
-                else:
-                    if self.lux < 220:
-                        self.lh_time += self.period
-                        if self.lh_time > LIGHT_HOLD_TIME:
-                            self.relay(1) # turn the light on
-                            self.ld_time = 0
-                            self.lh_time = 0
-                    else:
-                        self.lh_time = 0
+            # run the barometric sensor task, a new value comes after the 'BAR' step
+            fresh = self.ms5637.state == 'BAR'
+            self.ms5637.run()
+            if fresh:
+                self._sample('bar', self.ms5637.bar())
+            bus.publish('bar', self.ms5637.bar())
+
+        # the light control only has work on changes or when its timers expire
+        bus.publish('relay', self.relay())
+        self.light.poll()
+
+        self.supervisor.end(self.sv_task)
 
 class Email:
     def __init__(self, blynk):
@@ -304,49 +509,79 @@ class Notify:
         if self.enabled:
             self.blynk.notify(msg)
 
-wdt = WDT(timeout=WDT_TIMEOUT)
+# the demo only starts when run as the main script (see boot.py), the
+# host tools import this module for its classes
+if __name__ == '__main__':
+    supervisor = Supervisor(WDT(timeout=WDT_TIMEOUT))
+    # read the record of the last watchdog reset before the Wi-Fi connect replaces it
+    crash = supervisor.report()
+    wlan_task = supervisor.register('wlan', WDT_TIMEOUT, False)
+
+    wlan = WLAN(mode=WLAN.STA)
+    # the WDT will reset if this takes more than WDT_TIMEOUT seconds
+    supervisor.begin(wlan_task, True)
+    connect_to_wlan(wlan)
+    supervisor.end(wlan_task)
 
-wlan = WLAN(mode=WLAN.STA)
-connect_to_wlan(wlan) # the WDT will reset if this takes more than WDT_TIMEOUT seconds
+    supervisor.feed()
 
-wdt.feed()
+    # set the current time (mandatory to validate certificates)
+    RTC(datetime=(2016, 1, 1, 0, 0, 0, 0, None))
 
-# set the current time (mandatory to validate certificates)
-RTC(datetime=(2016, 1, 1, 0, 0, 0, 0, None))
+    # initialize Blynk with SSL enabled
+    # the ADC sampling service, also used by the analog reads of the app
+    sampler = ADCSampler()
 
-# initialize Blynk with SSL enabled
-blynk = BlynkLib.Blynk(BLYNK_AUTH, wdt=False, ssl=True)
+    blynk = BlynkLib.Blynk(BLYNK_AUTH, wdt=supervisor, ssl=True, state_file=BLYNK_STATE, sampler=sampler)
 
-# register the email handler on V5
-email = Email(blynk)
-blynk.add_virtual_pin(5, write=email.handler)
+    # register the email handler on V5
+    email = Email(blynk)
+    blynk.add_virtual_pin(5, write=email.handler, cache=True)
 
-# register the tweet handler on V6
-notify = Notify(blynk)
-blynk.add_virtual_pin(6, write=notify.handler)
+    # register the tweet handler on V6
+    notify = Notify(blynk)
+    blynk.add_virtual_pin(6, write=notify.handler, cache=True)
 
-# register the light switch relay write handler on V7
-relay = VirtualSw('GP23')
-blynk.add_virtual_pin(7, write=relay.handler)
+    # register the light switch relay write handler on V7
+    relay = VirtualSw('GP23')
+    blynk.add_virtual_pin(7, write=relay.handler, cache=True)
 
-# instantiate the battery monitor
-battery = BatteryMonitor('GP3')
+    # instantiate the battery monitor
+    battery = BatteryMonitor(sampler, 'GP3')
 
-# register the sensors task as the user task (uses V3 and V4)
-s_task = MainTask(blynk, 'GP30', 'GP17', 'GP14', relay, email, notify, battery, wdt, 36, MAIN_TASK_PERIOD)
-blynk.set_user_task(s_task.run, MAIN_TASK_PERIOD)
+    # register the sensors task as the user task (uses V3 and V4)
+    s_task = MainTask(blynk, 'GP30', 'GP17', 'GP14', relay, email, notify, battery, supervisor, 36, MAIN_TASK_PERIOD,
+                      sampler=sampler)
+    blynk.set_user_task(s_task.run, MAIN_TASK_PERIOD)
 
-# register the terminal REPL on v0
-term = blynk.repl(0)
-os.dupterm(term)
+    # collect the garbage in the idle gaps and watch the heap (V13)
+    gcm = GCManager(s_task.bus)
+    blynk.set_idle_task(gcm.idle)
+    # a MemoryError in a pin handler or in the main task sheds the optional
+    # work and the session goes on
+    blynk.set_memory_handler(gcm.emergency)
 
-while True:
-    wdt.feed()
-    try:
-        blynk.run() # run Blynk
-    except MemoryError:
-        machine.reset()
-    except Exception as e:
-        print(repr(e))
-        if not wlan.isconnected():
-            connect_to_wlan(wlan)
+    # register the terminal REPL on v0
+    term = blynk.repl(0)
+
+    # tell about the last watchdog reset, on the UART now and on the terminal once connected
+    if crash:
+        print(crash)
+        term.dump(crash + '\n')
+
+    os.dupterm(term)
+
+    while True:
+        supervisor.feed()
+        try:
+            blynk.run() # run Blynk
+        except MemoryError:
+            # out of memory outside of the handlers, e.g. while connecting. The
+            # session is lost, run() closes its socket and connects again
+            gcm.emergency()
+        except Exception as e:
+            print(repr(e))
+            if not wlan.isconnected():
+                supervisor.begin(wlan_task, True)
+                connect_to_wlan(wlan)
+                supervisor.end(wlan_task)
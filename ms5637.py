@@ -5,6 +5,8 @@
 import time
 
 class MS5637:
+    __slots__ = ('i2c', 'addr', 'state', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'D1', 'D2', '_bar')
+
     def __init__(self, i2c, addr=118):
         self.i2c = i2c
         self.addr = addr
@@ -7,12 +7,24 @@ OneWire library for MicroPython
 import time
 import machine
 
-class OneWire:
-    CMD_SEARCHROM = const(0xf0)
-    CMD_READROM = const(0x33)
-    CMD_MATCHROM = const(0x55)
-    CMD_SKIPROM = const(0xcc)
+CMD_SEARCHROM = const(0xf0)
+CMD_READROM = const(0x33)
+CMD_MATCHROM = const(0x55)
+CMD_SKIPROM = const(0xcc)
+
+CMD_CONVERT = const(0x44)
+CMD_RDSCRATCH = const(0xbe)
+CMD_WRSCRATCH = const(0x4e)
+CMD_CPYSCRATCH = const(0x48)
+CMD_RDPOWER = const(0xb4)
+
+EEPROM_WRITE_MS = const(10)
 
+# DS18B20 conversion time in ms and config register value for 9 to 12 bits
+CONV_TIME = (94, 188, 375, 750)
+CONFIG = (0x1f, 0x3f, 0x5f, 0x7f)
+
+class OneWire:
     def __init__(self, pin):
         self.pin = pin
         self.pin.init(pin.OPEN_DRAIN, pin.PULL_UP)
@@ -87,6 +99,18 @@ class OneWire:
         for b in buf:
             self.write_byte(b)
 
+    def strong_pullup(self, enable):
+        """
+        Drive the line high to power parasite devices during a temperature
+        conversion or an EEPROM copy. No other traffic is allowed meanwhile.
+        """
+        pin = self.pin
+        if enable:
+            pin(1)
+            pin.init(pin.OUT, None)
+        else:
+            pin.init(pin.OPEN_DRAIN, pin.PULL_UP)
+
     def select_rom(self, rom):
         """
         Select a specific device to talk to. Pass in rom as a bytearray (8 bytes).
@@ -158,42 +182,195 @@ class OneWire:
 
 class DS18X20(object):
     def __init__(self, onewire):
-        self.ow = onewire
-        self.roms = [rom for rom in self.ow.scan() if rom[0] == 0x10 or rom[0] == 0x28]
+        # one bus or a list of buses, each probe is addressed on its own bus
+        self.buses = list(onewire) if isinstance(onewire, (list, tuple)) else [onewire]
+        self.ow = self.buses[0]
+        self.roms = []
+        self.bus_of = [] # per probe, the index of its bus
+        for n in range(len(self.buses)):
+            for rom in self.buses[n].scan():
+                if rom[0] == 0x10 or rom[0] == 0x28:
+                    self.roms.append(rom)
+                    self.bus_of.append(n)
+        # per probe, in the order of roms
+        self.bits = [12 for rom in self.roms]
+        self.parasite = [self._read_power(idx) for idx in range(len(self.roms))]
+        self.conv_start = [None for rom in self.roms] # ticks_ms of CMD_CONVERT
+        self.temps = [None for rom in self.roms]
+        # per bus
+        self.powering = [False for bus in self.buses]
+        self.sweep_start = [None for bus in self.buses]
+        self.sweep_conv = [0 for bus in self.buses] # ms until the slowest probe of the sweep is done
+        self.sweep_next = [0 for bus in self.buses]
+
+    def _read_power(self, idx):
+        ow = self.buses[self.bus_of[idx]]
+        ow.select_rom(self.roms[idx])
+        ow.write_byte(CMD_RDPOWER)
+        return not ow.read_bit()
 
-    def isbusy(self):
+    def _release(self, bus=0):
+        if self.powering[bus]:
+            self.buses[bus].strong_pullup(False)
+            self.powering[bus] = False
+
+    def isbusy(self, bus=0):
         """
         Checks wether one of the DS18x20 devices on the bus is busy
-        performing a temperature convertion
+        performing a temperature convertion. Parasite powered devices
+        can't tell, wait for the time returned by start_convertion instead.
         """
-        return not self.ow.read_bit()
+        return not self.buses[bus].read_bit()
+
+    def set_resolution(self, bits, rom=None, save=False):
+        """
+        Set the resolution of one DS18B20 device to 9..12 bits, which takes
+        the conversion time from 750 ms down to 94 ms. With save=True the
+        setting is also copied to the EEPROM so that it survives a power cycle.
+        """
+        rom = rom or self.roms[0]
+        if rom[0] != 0x28 or bits < 9 or bits > 12:
+            raise ValueError('')
+        idx = self.roms.index(rom)
+        bus = self.bus_of[idx]
+        ow = self.buses[bus]
+        self._release(bus)
+        # keep the alarm registers as they are
+        ow.select_rom(rom)
+        ow.write_byte(CMD_RDSCRATCH)
+        data = ow.read_bytes(9)
+        ow.select_rom(rom)
+        ow.write_byte(CMD_WRSCRATCH)
+        ow.write_bytes((data[2], data[3], CONFIG[bits - 9]))
+        if save:
+            ow.select_rom(rom)
+            ow.write_byte(CMD_CPYSCRATCH)
+            if self.parasite[idx]:
+                ow.strong_pullup(True)
+            time.sleep_ms(EEPROM_WRITE_MS)
+            if self.parasite[idx]:
+                ow.strong_pullup(False)
+        self.bits[idx] = bits
+
+    def conversion_time(self, rom=None):
+        """
+        Conversion time of one device in ms, for its current resolution.
+        """
+        rom = rom or self.roms[0]
+        return CONV_TIME[self.bits[self.roms.index(rom)] - 9]
 
     def start_convertion(self, rom=None):
         """
         Start the temp conversion on one DS18x20 device.
         Pass the 8-byte bytes object with the ROM of the specific device you want to read.
         If only one DS18x20 device is attached to the bus you may omit the rom parameter.
+        Returns the time in ms until the result will be ready.
         """
         rom = rom or self.roms[0]
-        ow = self.ow
-        ow.reset()
+        idx = self.roms.index(rom)
+        bus = self.bus_of[idx]
+        ow = self.buses[bus]
+        # looked up before the command, the pull-up must follow it right away
+        parasite = self.parasite[idx]
+        self._release(bus)
         ow.select_rom(rom)
-        ow.write_byte(0x44)  # Convert Temp
+        ow.write_byte(CMD_CONVERT)
+        if parasite:
+            # the device draws its power from the line until it's done
+            ow.strong_pullup(True)
+            self.powering[bus] = True
+        self.conv_start[idx] = time.ticks_ms()
+        return CONV_TIME[self.bits[idx] - 9]
 
     def read_temp_async(self, rom=None):
         """
         Read the temperature of one DS18x20 device if the convertion is complete,
-        otherwise return None.
+        otherwise return None. Before the conversion time is over this doesn't
+        touch the bus at all.
         """
-        if self.isbusy():
-            return None
         rom = rom or self.roms[0]
-        ow = self.ow
-        ow.reset()
-        ow.select_rom(rom)
-        ow.write_byte(0xbe)  # Read scratch
+        idx = self.roms.index(rom)
+        bus = self.bus_of[idx]
+        start = self.conv_start[idx]
+        if start is None:
+            # not started by us, ask the bus
+            if self.isbusy(bus):
+                return None
+        elif time.ticks_diff(start, time.ticks_ms()) < CONV_TIME[self.bits[idx] - 9]:
+            return None
+        self.conv_start[idx] = None
+        return self._read(idx)
+
+    def _read(self, idx):
+        bus = self.bus_of[idx]
+        self._release(bus)
+        ow = self.buses[bus]
+        ow.select_rom(self.roms[idx])
+        ow.write_byte(CMD_RDSCRATCH)
         data = ow.read_bytes(9)
-        return self.convert_temp(rom[0], data)
+        return self.convert_temp(self.roms[idx][0], data)
+
+    def start_sweep(self):
+        """
+        Start the conversion on all the probes of all the buses at once (skip
+        ROM), the buses convert in parallel. Returns the time in ms until the
+        first bus can be read.
+        """
+        now = time.ticks_ms()
+        first = None
+        for bus in range(len(self.buses)):
+            probes = [idx for idx in range(len(self.roms)) if self.bus_of[idx] == bus]
+            if not probes:
+                continue
+            ow = self.buses[bus]
+            conv = 0
+            parasite = False
+            for idx in probes:
+                conv = max(conv, CONV_TIME[self.bits[idx] - 9])
+                parasite = parasite or self.parasite[idx]
+            self._release(bus)
+            ow.reset()
+            ow.write_byte(CMD_SKIPROM)
+            ow.write_byte(CMD_CONVERT)
+            if parasite:
+                # any parasite probe needs the pull-up right after the command
+                ow.strong_pullup(True)
+                self.powering[bus] = True
+            self.sweep_start[bus] = now
+            self.sweep_conv[bus] = conv
+            self.sweep_next[bus] = 0
+            if first is None or conv < first:
+                first = conv
+        return first or 0
+
+    def poll_sweep(self, reads=1):
+        """
+        Read up to reads probes on every bus whose conversion is over, so a
+        call blocks for a few ms only and the buses take turns. The results
+        go to temps (in the order of roms). Returns True once the sweep is done.
+        """
+        now = time.ticks_ms()
+        for bus in range(len(self.buses)):
+            start = self.sweep_start[bus]
+            if start is None or time.ticks_diff(start, now) < self.sweep_conv[bus]:
+                continue
+            n = 0
+            idx = self.sweep_next[bus]
+            while idx < len(self.roms) and n < reads:
+                if self.bus_of[idx] == bus:
+                    self.temps[idx] = self._read(idx)
+                    n += 1
+                idx += 1
+            # skip to the next probe of this bus, the sweep of the bus ends with the last one
+            while idx < len(self.roms) and self.bus_of[idx] != bus:
+                idx += 1
+            self.sweep_next[bus] = idx
+            if idx >= len(self.roms):
+                self.sweep_start[bus] = None
+        for start in self.sweep_start:
+            if start is not None:
+                return False
+        return True
 
     def convert_temp(self, rom0, data):
         """
@@ -213,6 +390,9 @@ class DS18X20(object):
             temp = 100 * temp_read - 25 + (count_per_c - count_remain) // count_per_c
             return temp
         elif rom0 == 0x28:
-            return (temp_msb << 8 | temp_lsb) * 100 // 16
+            temp = temp_msb << 8 | temp_lsb
+            if temp & 0x8000: # negative, two's complement
+                temp -= 0x10000
+            return temp * 100 // 16
         else:
             assert False
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# ADC sampling service. Every channel is sampled in short bursts into a
+# preallocated array, the burst is decimated to one value with 2 extra
+# bits (16 samples summed and shifted right by 2) and smoothed with an
+# integer low pass filter. The consumers read the latest filtered value
+# without touching the ADC.
+
+import array
+import time
+from machine import ADC
+
+SAMPLER_BURST = const(16)   # 4^2 samples give 2 extra bits, 14 bit results
+SAMPLER_PERIOD = const(100) # ms between the bursts of a channel
+SAMPLER_FILTER = const(2)   # low pass weight of a new burst is 1/4
+
+class ADCSampler:
+    __slots__ = ('adc', 'names', 'channels', 'values', 'bursts', 'buf', 'period', 'time')
+
+    def __init__(self, period=SAMPLER_PERIOD):
+        self.adc = ADC(bits=12)
+        self.names = []
+        self.channels = []
+        self.values = array.array('i')
+        self.bursts = array.array('I')
+        self.buf = array.array('H', (0 for i in range(SAMPLER_BURST)))
+        self.period = period
+        self.time = time.ticks_ms()
+
+    def add(self, pin):
+        """
+        Start sampling the analog pin and return its channel index. Adding
+        a pin again gives the same index and puts the pin back in analog mode.
+        """
+        if pin in self.names:
+            idx = self.names.index(pin)
+            self.channels[idx].init()
+            return idx
+        self.names.append(pin)
+        self.channels.append(self.adc.channel(pin=pin))
+        self.values.append(0)
+        self.bursts.append(0)
+        idx = len(self.names) - 1
+        self._burst(idx)
+        return idx
+
+    def _burst(self, idx):
+        buf = self.buf
+        channel = self.channels[idx]
+        for i in range(SAMPLER_BURST):
+            buf[i] = channel()
+        value = sum(buf) >> 2
+        if self.bursts[idx]:
+            self.values[idx] += (value - self.values[idx]) >> SAMPLER_FILTER
+        else:
+            self.values[idx] = value
+        self.bursts[idx] += 1
+
+    def run(self):
+        # called from the Blynk loop (Blynk(sampler=...)) and from the main
+        # task, samples all the channels once per period
+        now = time.ticks_ms()
+        if time.ticks_diff(self.time, now) >= self.period:
+            self.time = now
+            for idx in range(len(self.channels)):
+                self._burst(idx)
+
+    def value(self, idx):
+        # 14 bit filtered value
+        return self.values[idx]
+
+    def read(self, idx):
+        # 12 bit filtered value, on the scale of a single ADC sample
+        return (self.values[idx] + 2) >> 2
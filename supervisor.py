@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Watchdog supervisor. The hardware watchdog is only fed while all the
+# registered tasks keep making progress. When one of them stalls the
+# slowest task and for how long it was stuck are written to a small crash
+# record on flash before the watchdog resets the board, and the record is
+# reported on the next boot. Nothing feeds the watchdog during a long
+# blocking call (Wi-Fi or server connect, TLS handshake), so the task is
+# written to the record before the call and removed once it succeeds.
+# Retries of a failing call keep the record as it is, the flash is written
+# once per outage and not on every attempt.
+
+import os
+import time
+import machine
+
+CRASH_FILE = '/flash/crash.txt'
+
+class Supervisor:
+    __slots__ = ('wdt', 'path', 'names', 'limits', 'periodic', 'started', 'done', 'max_ms', 'stalled', 'marked', 'on_flash')
+
+    def __init__(self, wdt, path=CRASH_FILE):
+        self.wdt = wdt
+        self.path = path
+        self.names = []
+        self.limits = []
+        self.periodic = []
+        self.started = [] # start of the current run, None when not running
+        self.done = []    # end of the last run
+        self.max_ms = []  # duration of the longest run
+        self.stalled = False
+        self.marked = -1    # task written to the record by begin()
+        self.on_flash = -1  # task of the marker on flash, -1 if there is none
+
+    def register(self, name, limit, periodic=True):
+        """
+        Add a task which must make progress at least every limit ms. A task
+        which only runs on demand (periodic=False) is only checked while it
+        runs. Returns the task id for begin() and end().
+        """
+        self.names.append(name)
+        self.limits.append(limit)
+        self.periodic.append(periodic)
+        self.started.append(None)
+        self.done.append(time.ticks_ms())
+        self.max_ms.append(0)
+        return len(self.names) - 1
+
+    def begin(self, task, mark=False):
+        # mark=True before a blocking call, if it never returns the record
+        # already names the task
+        self.started[task] = time.ticks_ms()
+        if mark and not self.stalled:
+            self.marked = task
+            if self.on_flash != task:
+                self._save(task, -1)
+                self.on_flash = task
+
+    def end(self, task, done=True):
+        # also usable on its own as a plain progress mark. done=False after a
+        # failed blocking call which is going to be retried keeps its marker
+        now = time.ticks_ms()
+        start = self.started[task]
+        if start is not None:
+            elapsed = time.ticks_diff(start, now)
+            if elapsed > self.max_ms[task]:
+                self.max_ms[task] = elapsed
+            self.started[task] = None
+        self.done[task] = now
+        if self.marked == task:
+            self.marked = -1
+            if done and not self.stalled:
+                self._remove()
+
+    def feed(self):
+        now = time.ticks_ms()
+        stuck = -1
+        stuck_ms = 0
+        for task in range(len(self.names)):
+            # a running task counts from its start, otherwise from its last run
+            start = self.started[task]
+            if start is None and not self.periodic[task]:
+                continue
+            age = time.ticks_diff(self.done[task] if start is None else start, now)
+            if age > self.limits[task] and age > stuck_ms:
+                stuck = task
+                stuck_ms = age
+        if stuck < 0:
+            if self.stalled:
+                # it recovered before the reset, drop the record
+                self.stalled = False
+                self._remove()
+            self.wdt.feed()
+        elif not self.stalled:
+            # stop feeding and let the watchdog reset the board
+            self.stalled = True
+            self._save(stuck, stuck_ms)
+            self.on_flash = -1
+
+    def _slowest(self):
+        slowest = 0
+        for task in range(1, len(self.names)):
+            if self.max_ms[task] > self.max_ms[slowest]:
+                slowest = task
+        return slowest
+
+    def _save(self, task, stuck_ms):
+        slowest = self._slowest()
+        try:
+            with open(self.path, 'w') as f:
+                f.write('{},{},{},{}\n'.format(self.names[task], stuck_ms, self.names[slowest], self.max_ms[slowest]))
+        except OSError:
+            pass
+
+    def _remove(self):
+        self.on_flash = -1
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def report(self):
+        """
+        Describe the last reset caused by a stalled task and clear the record.
+        Returns None if there is nothing to report.
+        """
+        try:
+            with open(self.path) as f:
+                name, stuck_ms, slowest, slowest_ms = f.read().strip().split(',')
+        except (OSError, ValueError):
+            if machine.reset_cause() == machine.WDT_RESET:
+                return 'watchdog reset, no record of the blocked task'
+            return None
+        self._remove()
+        if stuck_ms == '-1':
+            # written before a blocking call which didn't return, a power
+            # cut leaves it behind as well
+            if machine.reset_cause() != machine.WDT_RESET:
+                return None
+            return 'watchdog reset: blocked in {}, slowest run was {} with {} ms'.format(name, slowest, slowest_ms)
+        return 'watchdog reset: {} stalled for {} ms, slowest run was {} with {} ms'.format(
+            name, stuck_ms, slowest, slowest_ms)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# End to end latency benchmarks of the iotdemo application, running on
+# the simulated hardware against the local stub server:
+#
+#  sensor:   the BH1750FVI lux value changes -> its V8 write reaches the server
+#  actuator: the server writes V7 -> VirtualSw drives the relay pin (GP23)
+#  flood:    the server floods V9 (LED delay slider), loop throughput and
+#            how many MainTask ticks still ran on time
+#
+# The result is printed (or written with --out) as JSON, for tracking
+# regressions between releases. With --capture the client side traffic
+# is recorded for tools/replay.py.
+#
+# python3 tools/bench_e2e.py --samples 30 --flood-seconds 5 --out bench.json
+
+import argparse
+import json
+import platform
+import random
+import threading
+import time
+
+import hostsim
+hostsim.install()
+
+from hostsim import ticks_us
+from simdemo import Demo
+from stubserver import StubServer
+
+class _Done(Exception):
+    pass
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pct = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {'n': len(values), 'min': values[0], 'p50': pct(0.5), 'p95': pct(0.95), 'max': values[-1],
+            'mean': round(sum(values) / len(values), 2)}
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.server = StubServer().start_in_thread()
+        self.server.on_frame.append(self._on_frame)
+        self.demo = Demo(self.server.port, capture=args.capture)
+        self.rnd = random.Random(1)
+        self.expect = None
+        self.arrived = threading.Event()
+        self.arrival = 0
+        self.done = False
+        self.ticks = 0
+        self.results = {}
+
+    def _on_frame(self, session, msg_type, msg_id, body, now):
+        if self.expect is not None and body == self.expect:
+            self.arrival = now
+            self.expect = None
+            self.arrived.set()
+
+    def sensor(self):
+        lat = []
+        lux = self.demo.bh1750fvi
+        for i in range(self.args.samples):
+            time.sleep(self.rnd.uniform(0.05, 0.3))
+            new = 600 if lux.lux < 300 else 50
+            self.arrived.clear()
+            self.expect = bytes('vw\x008\x00{}'.format(new * 1000 // 1200 * 1200 // 1000), 'ascii')
+            start = ticks_us()
+            lux.lux = new
+            if self.arrived.wait(5):
+                lat.append(round((self.arrival - start) / 1000, 2))
+        return summary(lat)
+
+    def actuator(self):
+        lat = []
+        pin = hostsim.pins['GP23']
+        got = threading.Event()
+        when = [0]
+        def watcher(p, value):
+            when[0] = ticks_us()
+            got.set()
+        pin.watchers.append(watcher)
+        for i in range(self.args.samples):
+            time.sleep(self.rnd.uniform(0.05, 0.3))
+            got.clear()
+            start = ticks_us()
+            self.server.call(self.server.send_hw, 'vw', 7, (i + 1) % 2)
+            if got.wait(5):
+                lat.append(round((when[0] - start) / 1000, 2))
+        pin.watchers.remove(watcher)
+        return summary(lat)
+
+    def flood(self):
+        blynk = self.demo.blynk
+        handled = [0]
+        vr_pin = blynk._vr_pins[9]
+        handler = vr_pin.write
+        def counting(value):
+            handled[0] += 1
+            handler(value)
+        vr_pin.write = counting
+        sent = 0
+        ticks = self.ticks
+        start = time.monotonic()
+        end = start + self.args.flood_seconds
+        while time.monotonic() < end:
+            self.server.call(self._burst, sent)
+            sent += self.args.flood_burst
+            time.sleep(0.005)
+        # let the client drain what is in flight
+        time.sleep(0.5)
+        elapsed = time.monotonic() - start
+        vr_pin.write = handler
+        expected_ticks = elapsed * 1000 / 50
+        return {'sent': sent, 'handled': handled[0], 'handled_per_sec': round(handled[0] / elapsed, 1),
+                'task_ticks': self.ticks - ticks, 'task_ticks_expected': int(expected_ticks)}
+
+    def _burst(self, first):
+        for i in range(first, first + self.args.flood_burst):
+            self.server.send_hw('vw', 9, i % 11)
+
+    def driver(self):
+        try:
+            time.sleep(1) # connected and through the first sensor reads
+            self.results['sensor_to_server_ms'] = self.sensor()
+            self.results['server_to_actuator_ms'] = self.actuator()
+            self.results['slider_flood'] = self.flood()
+        finally:
+            self.done = True
+
+    def run(self):
+        task = self.demo.task.run
+        def wrapped():
+            self.ticks += 1
+            if self.done:
+                raise _Done()
+            task()
+        self.demo.blynk.set_user_task(wrapped, 50)
+        threading.Thread(target=self.driver, daemon=True).start()
+        try:
+            self.demo.blynk.run()
+        except _Done:
+            pass
+        self.demo.blynk.stop_capture()
+        self.results['meta'] = {'time': int(time.time()), 'python': platform.python_version(),
+                                'samples': self.args.samples, 'blynk_stats': self.demo.blynk.stats}
+        fps, frames, dropped = self.demo.task.ledshow.stats()
+        self.results['leds'] = {'frames': frames, 'dropped': dropped}
+        bus = self.demo.task.bus
+        self.results['pipeline'] = {'published': bus.published, 'callbacks': bus.delivered,
+                                    'callbacks_polling': bus.polled}
+        return self.results
+
+def main():
+    parser = argparse.ArgumentParser(description='iotdemo end to end latency benchmarks')
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--flood-seconds', type=float, default=3)
+    parser.add_argument('--flood-burst', type=int, default=10, help='V9 writes per 5 ms')
+    parser.add_argument('--out', help='write the JSON result to this file')
+    parser.add_argument('--capture', help='record the Blynk session to this file')
+    args = parser.parse_args()
+    result = json.dumps(Bench(args).run(), indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Compare the hardware command parser in BlynkLib with the split/decode
+# parser it replaced, on a recorded stream of server messages. The
+# stream is a file of raw Blynk frames (header + body) as sent by the
+# server. Without --stream a dashboard slider flood is synthesized
+# (V9 LED delay, V2 colour button, V7 relay, V5/V6 enables, now and then
+# a multi value write longer than MAX_HW_ARGS).
+#
+# Besides the time per message it reports the memory allocated per
+# message, measured with tracemalloc like tools/bench_tx_alloc.py, so the
+# numbers are CPython object sizes and only a proxy for the MicroPython
+# heap.
+#
+# python3 tools/bench_hw_parser.py [--stream FILE] [--save FILE]
+
+import argparse
+import json
+import random
+import struct
+import time
+import tracemalloc
+
+import hostsim
+hostsim.install()
+
+import BlynkLib
+from BlynkLib import HDR_FMT, HDR_LEN, MSG_HW, MSG_BRIDGE
+
+def legacy_handle_hw(self, data):
+    # the parser as it was before the in place version
+    params = list(map(lambda x: x.decode('ascii'), data.split(b'\0')))
+    cmd = params.pop(0)
+    if cmd == 'info':
+        pass
+    elif cmd == 'vw':
+        pin = int(params.pop(0))
+        if pin in self._vr_pins and self._vr_pins[pin].write:
+            for param in params:
+                self._vr_pins[pin].write(param)
+    elif cmd == 'vr':
+        pin = int(params.pop(0))
+        if pin in self._vr_pins and self._vr_pins[pin].read:
+            self._vr_pins[pin].read()
+
+def synthesize(count, seed=1):
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(count):
+        r = rnd.random()
+        if r < 0.005:
+            args = ('vw', 2) + tuple(rnd.randint(0, 255) for n in range(BlynkLib.MAX_HW_ARGS + 8))
+        elif r < 0.7:
+            args = ('vw', 9, rnd.randint(0, 10))
+        elif r < 0.85:
+            args = ('vw', 2, rnd.randint(0, 1))
+        elif r < 0.95:
+            args = ('vw', 7, rnd.randint(0, 1))
+        else:
+            args = ('vw', rnd.choice((5, 6)), rnd.randint(0, 1))
+        body = bytes('\0'.join(map(str, args)), 'ascii')
+        frames.append(struct.pack(HDR_FMT, MSG_HW, i % 0xFFFF + 1, len(body)) + body)
+    return b''.join(frames)
+
+def bodies(stream):
+    out = []
+    pos = 0
+    while pos + HDR_LEN <= len(stream):
+        msg_type, msg_id, msg_len = struct.unpack_from(HDR_FMT, stream, pos)
+        pos += HDR_LEN
+        if msg_type == MSG_HW or msg_type == MSG_BRIDGE:
+            out.append(bytes(stream[pos:pos + msg_len]))
+            pos += msg_len
+    return out
+
+def run(handle, blynk, msgs, repeat):
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for data in msgs:
+            handle(blynk, data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def alloc(handle, blynk, msgs):
+    # bytes allocated per message, the values kept by the handlers included
+    tracemalloc.start()
+    total = 0
+    for data in msgs:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        handle(blynk, data)
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total / len(msgs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Hardware command parser benchmark')
+    parser.add_argument('--stream', help='file with raw server frames')
+    parser.add_argument('--save', help='write the synthesized stream to this file')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthesize(args.count)
+        if args.save:
+            with open(args.save, 'wb') as f:
+                f.write(stream)
+    msgs = bodies(stream)
+
+    blynk = BlynkLib.Blynk('token', connect=False, wdt=False)
+    seen = []
+    for pin in (2, 5, 6, 7, 9):
+        blynk.add_virtual_pin(pin, write=seen.append)
+    blynk._hw_pins = {}
+    blynk._pins_configured = False
+
+    legacy = run(legacy_handle_hw, blynk, msgs, args.repeat)
+    legacy_seen = seen[:]
+    del seen[:]
+    current = run(BlynkLib.Blynk._handle_hw, blynk, msgs, args.repeat)
+    assert seen == legacy_seen, 'the parsers disagree'
+    del seen[:]
+    legacy_bytes = alloc(legacy_handle_hw, blynk, msgs)
+    del seen[:]
+    current_bytes = alloc(BlynkLib.Blynk._handle_hw, blynk, msgs)
+    print(json.dumps({
+        'messages': len(msgs),
+        'legacy_us_per_msg': round(legacy * 1e6 / len(msgs), 3),
+        'current_us_per_msg': round(current * 1e6 / len(msgs), 3),
+        'speedup': round(legacy / current, 2),
+        'legacy_bytes_per_msg': round(legacy_bytes, 1),
+        'current_bytes_per_msg': round(current_bytes, 1),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
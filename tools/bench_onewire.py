@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# DS18B20 sweep time with the probes on one or on several OneWire buses,
+# on simulated buses (hostsim.OneWireBus). The reads run from a tick loop
+# like MainTask does, the conversions take their real time and the bit
+# banged bus transfers are added from the bus time accounting, since the
+# CPU does them one after the other.
+#
+#  per_probe: one probe converted and read after the other (the old loop)
+#  sweep_1:   all the probes on one bus, converted together
+#  sweep_N:   the probes spread over N buses, converted together and read
+#             in turns
+#
+# python3 tools/bench_onewire.py --probes 8 --buses 4 --bits 9
+
+import argparse
+import json
+import time
+
+import hostsim
+hostsim.install()
+
+import onewire
+from hostsim import DS18B20Sim, OneWireBus
+
+def make(probes, buses, bits, parasite):
+    devices = [DS18B20Sim(n + 1, temp=2000 + n * 25, parasite=parasite) for n in range(probes)]
+    owbuses = [OneWireBus(devices[n::buses]) for n in range(buses)]
+    ds = onewire.DS18X20(owbuses)
+    for rom in ds.roms:
+        ds.set_resolution(bits, rom)
+    return ds, owbuses
+
+def bus_us(owbuses):
+    return sum(bus.elapsed_us for bus in owbuses)
+
+class Run:
+    def __init__(self, owbuses, tick_ms):
+        self.owbuses = owbuses
+        self.tick_ms = tick_ms
+        self.ticks = 0
+        self.max_tick_us = 0
+        self.start = time.monotonic()
+        self.start_us = bus_us(owbuses)
+
+    def tick(self, fn):
+        time.sleep(self.tick_ms / 1000)
+        before = bus_us(self.owbuses)
+        result = fn()
+        self.ticks += 1
+        self.max_tick_us = max(self.max_tick_us, bus_us(self.owbuses) - before)
+        return result
+
+    def result(self):
+        transfer_ms = (bus_us(self.owbuses) - self.start_us) / 1000
+        return {'sweep_ms': round((time.monotonic() - self.start) * 1000 + transfer_ms, 1),
+                'bus_ms': round(transfer_ms, 1), 'ticks': self.ticks,
+                'max_tick_bus_ms': round(self.max_tick_us / 1000, 1)}
+
+def per_probe(ds, owbuses, tick_ms):
+    run = Run(owbuses, tick_ms)
+    temps = []
+    for rom in ds.roms:
+        ds.start_convertion(rom)
+        tmp = None
+        while tmp is None:
+            tmp = run.tick(lambda: ds.read_temp_async(rom))
+        temps.append(tmp)
+    return run.result(), temps
+
+def sweep(ds, owbuses, tick_ms, reads):
+    run = Run(owbuses, tick_ms)
+    ds.start_sweep()
+    while not run.tick(lambda: ds.poll_sweep(reads)):
+        pass
+    return run.result(), list(ds.temps)
+
+def main():
+    parser = argparse.ArgumentParser(description='OneWire multi bus sweep benchmark')
+    parser.add_argument('--probes', type=int, default=8)
+    parser.add_argument('--buses', type=int, default=4)
+    parser.add_argument('--bits', type=int, default=9, help='DS18B20 resolution, 9 to 12')
+    parser.add_argument('--tick', type=int, default=50, help='main task period in ms')
+    parser.add_argument('--reads', type=int, default=1, help='probe reads per bus and tick')
+    parser.add_argument('--parasite', action='store_true', help='parasite powered probes')
+    args = parser.parse_args()
+
+    ds, owbuses = make(args.probes, 1, args.bits, args.parasite)
+    results = {'per_probe': per_probe(ds, owbuses, args.tick)}
+    results['sweep_1'] = sweep(ds, owbuses, args.tick, args.reads)
+    ds, owbuses = make(args.probes, args.buses, args.bits, args.parasite)
+    results['sweep_{}'.format(args.buses)] = sweep(ds, owbuses, args.tick, args.reads)
+
+    expected = results['per_probe'][1]
+    out = {'probes': args.probes, 'buses': args.buses, 'bits': args.bits, 'tick_ms': args.tick}
+    for name, (result, temps) in results.items():
+        # the multi bus front end orders the probes by bus
+        assert sorted(temps) == sorted(expected), name
+        out[name] = result
+    print(json.dumps(out, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Measure the memory allocated while formatting and sending one message,
+# for the transmit buffer encoder in BlynkLib and for the join/pack
+# encoder it replaced. Uses tracemalloc, so the numbers are CPython
+# object sizes, which are only a proxy for the MicroPython heap.
+#
+# python3 tools/bench_tx_alloc.py
+
+import argparse
+import json
+import struct
+import time
+import tracemalloc
+
+import hostsim
+hostsim.install()
+
+import BlynkLib
+from BlynkLib import HDR_FMT, MSG_HW
+
+def legacy_format_msg(self, msg_type, *args):
+    data = bytes('\0'.join(map(str, args)), 'ascii')
+    return struct.pack(HDR_FMT, msg_type, self._new_msg_id(), len(data)) + data
+
+class NullConn:
+    def send(self, data):
+        return len(data)
+
+# the virtual writes done by MainTask
+MESSAGES = (('vw', 3, '21.56'), ('vw', 4, '1013'), ('vw', 8, 512), ('vw', 12, 'Night'),
+            ('vw', 11, '85 %'), ('vw', 1, True), ('vw', 9, -7))
+
+def measure(blynk, fmt, count):
+    tracemalloc.start()
+    peak = 0
+    for i in range(count):
+        args = MESSAGES[i % len(MESSAGES)]
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        blynk._send(fmt(blynk, MSG_HW, *args))
+        peak += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for i in range(count):
+        blynk._send(fmt(blynk, MSG_HW, *MESSAGES[i % len(MESSAGES)]))
+    elapsed = time.perf_counter() - start
+    return peak / count, elapsed * 1e6 / count
+
+def main():
+    parser = argparse.ArgumentParser(description='Transmit path allocation benchmark')
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    blynk = BlynkLib.Blynk('token', connect=False, wdt=False)
+    blynk.conn = NullConn()
+    blynk._msg_id = 1
+    blynk._tx_count = 0
+    # nothing resets the tx budget here, lift it so that every message is sent
+    BlynkLib.MAX_MSG_PER_SEC = args.count * 2
+
+    for msg in MESSAGES:
+        msg_id = blynk._msg_id
+        legacy = legacy_format_msg(blynk, MSG_HW, *msg)
+        blynk._msg_id = msg_id
+        assert bytes(blynk._format_msg(MSG_HW, *msg)) == legacy, msg
+
+    legacy_bytes, legacy_us = measure(blynk, legacy_format_msg, args.count)
+    current_bytes, current_us = measure(blynk, BlynkLib.Blynk._format_msg, args.count)
+    print(json.dumps({
+        'messages': args.count,
+        'legacy_bytes_per_msg': round(legacy_bytes, 1),
+        'current_bytes_per_msg': round(current_bytes, 1),
+        'legacy_us_per_msg': round(legacy_us, 3),
+        'current_us_per_msg': round(current_us, 3),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
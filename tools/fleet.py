@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Load generator that runs many simulated devices in one asyncio process.
+# Every device logs in, sends the virtual writes MainTask does (DS18B20
+# temperature on V3, pressure on V4, lux and day/night on V8/V12,
+# battery on V11 and both push buttons on V1/V10 once a second), answers
+# the server pings and sends its own heartbeat like BlynkLib. Reconnect
+# storms drop a share of the devices at once and reconnect them.
+#
+# python3 tools/fleet.py --devices 2000 --seconds 30 --storm-every 10 --storm-share 0.5
+# python3 tools/fleet.py --server blynk.example --port 8442 --tokens tokens.txt
+#
+# Without --server a local stub server is started in the same process,
+# which accepts any token. A real server needs real auth tokens, either
+# from a file with one token per line (--tokens, one device per token) or
+# as --token-prefix followed by the device number ({:05d}).
+# Large fleets need a matching open files limit (ulimit -n).
+
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+
+import hostsim
+hostsim.install()
+
+from BlynkLib import (HDR_FMT, HDR_LEN, HB_PERIOD, MAX_SOCK_TO, MSG_RSP, MSG_LOGIN, MSG_PING, MSG_HW,
+                      STA_SUCCESS, _arg_bytes)
+from iotdemo import centi_str
+from stubserver import StubServer
+
+class Stats:
+    def __init__(self):
+        self.tx = 0
+        self.rx = 0
+        self.connects = 0
+        self.connect_fails = 0
+        self.login_fails = 0
+        self.hb_timeouts = 0
+        self.drops = 0
+        self.connect_ms = []
+
+    def report(self, seconds):
+        lat = sorted(self.connect_ms)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(len(lat) * p))], 2) if lat else None
+        return {
+            'tx_msgs': self.tx,
+            'rx_msgs': self.rx,
+            'tx_msgs_per_sec': round(self.tx / seconds, 1),
+            'rx_msgs_per_sec': round(self.rx / seconds, 1),
+            'connects': self.connects,
+            'connect_fails': self.connect_fails,
+            'login_fails': self.login_fails,
+            'heartbeat_timeouts': self.hb_timeouts,
+            'storm_drops': self.drops,
+            'connect_ms': {'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99),
+                           'max': round(lat[-1], 2) if lat else None},
+        }
+
+class Device:
+    def __init__(self, fleet, n, token):
+        self.fleet = fleet
+        self.token = token
+        self.rnd = random.Random(n)
+        self.msg_id = 0
+        self.writer = None
+        self.hb_id = 0
+        self.hb_time = 0
+        self.drop = asyncio.Event()
+        # sensor state, drifting like the real ones do
+        self.temp = 2000 + self.rnd.randint(-300, 300)
+        self.bar = 101300 + self.rnd.randint(-500, 500)
+        self.lux = self.rnd.randint(0, 800)
+        self.charge = 100
+
+    def _send(self, msg_type, *args):
+        data = b'\0'.join(map(_arg_bytes, args))
+        self.msg_id = self.msg_id % 0xFFFF + 1
+        self.writer.write(struct.pack(HDR_FMT, msg_type, self.msg_id, len(data)) + data)
+        self.fleet.stats.tx += 1
+        return self.msg_id
+
+    def vw(self, pin, val):
+        self._send(MSG_HW, 'vw', pin, val)
+
+    async def _login(self):
+        fleet = self.fleet
+        start = time.perf_counter()
+        try:
+            reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(fleet.host, fleet.port), MAX_SOCK_TO)
+            self._send(MSG_LOGIN, self.token)
+            hdr = await asyncio.wait_for(reader.readexactly(HDR_LEN), MAX_SOCK_TO)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            fleet.stats.connect_fails += 1
+            return None
+        msg_type, msg_id, status = struct.unpack(HDR_FMT, hdr)
+        if status != STA_SUCCESS:
+            fleet.stats.login_fails += 1
+            return None
+        fleet.stats.connects += 1
+        fleet.stats.connect_ms.append((time.perf_counter() - start) * 1000)
+        return reader
+
+    async def _reader(self, reader):
+        stats = self.fleet.stats
+        while True:
+            msg_type, msg_id, msg_len = struct.unpack(HDR_FMT, await reader.readexactly(HDR_LEN))
+            stats.rx += 1
+            if msg_type == MSG_RSP:
+                if msg_id == self.hb_id:
+                    self.hb_id = 0
+            elif msg_type == MSG_PING:
+                self.writer.write(struct.pack(HDR_FMT, MSG_RSP, msg_id, STA_SUCCESS))
+            elif msg_len:
+                await reader.readexactly(msg_len)
+
+    async def _telemetry(self):
+        fleet = self.fleet
+        rnd = self.rnd
+        tick = 0
+        period = fleet.period
+        while True:
+            await asyncio.sleep(period / 1000)
+            tick += period
+            now = time.monotonic()
+            if tick % fleet.temp_ms < period:
+                self.temp += rnd.randint(-6, 6)
+                self.vw(3, centi_str(self.temp))
+            if tick % fleet.bar_ms < period:
+                self.bar += rnd.randint(-20, 20)
+                self.vw(4, self.bar // 100)
+            if tick % fleet.lux_ms < period:
+                lux = max(0, self.lux + rnd.randint(-15, 15))
+                if lux != self.lux or tick % 1000 < period:
+                    self.lux = lux
+                    self.vw(8, lux)
+                    self.vw(12, 'Day' if lux > 100 else 'Night')
+            if tick % 1000 < period:
+                self.vw(1, True)
+                self.vw(10, True)
+            if tick % fleet.battery_ms < period:
+                self.vw(11, '{} %'.format(self.charge))
+            # heartbeat, same rules as BlynkLib._server_alive
+            if self.hb_id and now - self.hb_time >= MAX_SOCK_TO:
+                fleet.stats.hb_timeouts += 1
+                return
+            if now - self.hb_time >= HB_PERIOD:
+                self.hb_time = now
+                self.hb_id = self._send(MSG_PING)
+
+    async def run(self, stop):
+        # spread the initial logins over the ramp time
+        await asyncio.sleep(self.rnd.random() * self.fleet.ramp)
+        while not stop.is_set():
+            reader = await self._login()
+            if reader is None:
+                await asyncio.sleep(1)
+                continue
+            self.drop.clear()
+            self.hb_id = 0
+            self.hb_time = time.monotonic() - HB_PERIOD
+            tasks = [asyncio.ensure_future(c) for c in
+                     (self._reader(reader), self._telemetry(), self.drop.wait(), stop.wait())]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in tasks:
+                t.cancel()
+            self.writer.close()
+            if not stop.is_set():
+                await asyncio.sleep(1) # RECONNECT_DELAY
+
+class Fleet:
+    def __init__(self, host, port, args):
+        self.host = host
+        self.port = port
+        self.stats = Stats()
+        self.period = args.period
+        self.temp_ms = args.temp_ms
+        self.bar_ms = args.bar_ms
+        self.lux_ms = args.lux_ms
+        self.battery_ms = args.battery_ms
+        self.ramp = args.ramp
+        self.devices = [Device(self, n, token) for n, token in enumerate(tokens(args))]
+
+    async def storms(self, every, share, stop):
+        rnd = random.Random(0)
+        while not stop.is_set():
+            await asyncio.sleep(every)
+            victims = rnd.sample(self.devices, int(len(self.devices) * share))
+            self.stats.drops += len(victims)
+            for dev in victims:
+                dev.drop.set()
+
+def tokens(args):
+    if args.tokens:
+        with open(args.tokens, 'rb') as f:
+            return [line.strip() for line in f if line.strip()]
+    prefix = bytes(args.token_prefix, 'ascii')
+    return [prefix + bytes('{:05d}'.format(n), 'ascii') for n in range(args.devices)]
+
+async def _main(args):
+    if args.server:
+        host, port = args.server, args.port
+    else:
+        server = await StubServer(port=0).start()
+        host, port = '127.0.0.1', server.port
+    fleet = Fleet(host, port, args)
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(dev.run(stop)) for dev in fleet.devices]
+    if args.storm_every:
+        tasks.append(asyncio.ensure_future(fleet.storms(args.storm_every, args.storm_share, stop)))
+    start = time.monotonic()
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    report = fleet.stats.report(time.monotonic() - start)
+    report['devices'] = len(fleet.devices)
+    if not args.server:
+        report['server'] = server.stats
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Blynk device fleet')
+    parser.add_argument('--server', help='server to load, a local stub server is used if omitted')
+    parser.add_argument('--port', type=int, default=8442)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--tokens', help='file with one auth token per line, one device per token')
+    parser.add_argument('--token-prefix', default='device', help='token of device n is the prefix and n as {:05d}')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--ramp', type=float, default=2, help='seconds over which the devices log in')
+    parser.add_argument('--period', type=int, default=50, help='device task period in ms')
+    parser.add_argument('--temp-ms', type=int, default=800)
+    parser.add_argument('--bar-ms', type=int, default=300)
+    parser.add_argument('--lux-ms', type=int, default=100)
+    parser.add_argument('--battery-ms', type=int, default=250)
+    parser.add_argument('--storm-every', type=float, default=0, help='seconds between reconnect storms')
+    parser.add_argument('--storm-share', type=float, default=0.25, help='share of devices dropped per storm')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(_main(args)), indent=2))
+
+if __name__ == '__main__':
+    main()
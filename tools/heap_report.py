@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Report the memory held by each driver and task object of the iotdemo
+# application. The constructors of the reported classes are wrapped to
+# measure the gc.mem_alloc() growth over them (collected before and
+# after), less what the reported objects they construct themselves take.
+# An object is charged for its instance storage and for the containers it
+# creates, but not for what is added to it after its constructor returns.
+#
+# On the board that is the byte count on the MicroPython heap. Copy this
+# file to /flash next to the application and run
+#
+#   import heap_report; heap_report.board()
+#
+# board() builds the whole application on the real pins: the relay pin
+# is driven low, Timer 0 and the push button IRQs are taken. It must run
+# INSTEAD of the demo (boot without starting iotdemo, e.g. with the main
+# script renamed), never next to a running one. The hardware pin probes
+# of the host report are left out on the board, they would turn the I2C
+# pins into GPIOs.
+#
+# On the host the application is built on the simulated hardware, where
+# gc.mem_alloc() follows tracemalloc (see hostsim), so the figures are
+# CPython allocations. The host report also has the sys.getsizeof walk
+# over the containers an object owns (cpython_bytes) as a secondary
+# number. Either is a relative measure to track between versions
+# (--baseline).
+#
+# python3 tools/heap_report.py --out heap.json
+# python3 tools/heap_report.py --baseline heap.json
+
+import gc
+import sys
+
+if sys.implementation.name != 'micropython':
+    import types
+    import hostsim
+    hostsim.install()
+    _SKIP = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType)
+
+import BlynkLib
+
+def _classes():
+    import iotdemo
+    import onewire
+    from bh1750fvi import BH1750FVI
+    from ms5637 import MS5637
+    from ws2812 import WS2812
+    return (BlynkLib.Blynk, BlynkLib.Terminal, BlynkLib.VrPin, BlynkLib.HwPin, iotdemo.Email, iotdemo.Notify,
+            iotdemo.VirtualSw, iotdemo.BatteryMonitor, iotdemo.MainTask, iotdemo.HwSw, iotdemo.LedShow,
+            BH1750FVI, MS5637, onewire.DS18X20, WS2812)
+
+def _wrap(cls, sizes, stack):
+    init = cls.__init__
+    def __init__(self, *args, **kwargs):
+        stack.append(0)
+        gc.collect()
+        start = gc.mem_alloc()
+        init(self, *args, **kwargs)
+        gc.collect()
+        size = gc.mem_alloc() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += size
+        sizes[id(self)] = size - nested
+    cls.__init__ = __init__
+
+def objects(app, hw_pins=False):
+    task = app.task
+    blynk = app.blynk
+    if hw_pins:
+        # what the app pins configured from the dashboard take, host only
+        blynk._hw_pins = {12: BlynkLib.HwPin(12, 'out', 'out'), 3: BlynkLib.HwPin(3, 'in', 'in')}
+        blynk._hw_pins[12].digital_read()
+        blynk._hw_pins[3].analog_read()
+    named = [('blynk', blynk), ('terminal', app.term), ('email', app.email), ('notify', app.notify),
+             ('relay', app.relay), ('battery', app.battery), ('main_task', task)]
+    for name in ('sw1', 'sw2', 'ledshow', 'bh1750fvi', 'ms5637', 'ds18b20'):
+        named.append((name, getattr(task, name)))
+    named.append(('ws2812', task.ledshow.chain))
+    for pin, vr_pin in sorted(blynk._vr_pins.items()):
+        named.append(('vr_pin{}'.format(pin), vr_pin))
+    for pin, hw_pin in sorted(getattr(blynk, '_hw_pins', {}).items()):
+        named.append(('hw_pin{}'.format(pin), hw_pin))
+    return named
+
+def measure(build, hw_pins=False):
+    """
+    Build the application with build() and return the named objects and
+    the heap bytes of each one, keyed by id().
+    """
+    sizes = {}
+    stack = []
+    for cls in _classes():
+        _wrap(cls, sizes, stack)
+    named = objects(build(), hw_pins)
+    return named, sizes
+
+class _App:
+    pass
+
+class _NoWDT:
+    def feed(self):
+        pass
+
+def _board_app():
+    # the wiring of iotdemo, with a watchdog that doesn't bite and without connecting
+    import iotdemo
+    from supervisor import Supervisor
+    from sampler import ADCSampler
+    app = _App()
+    supervisor = Supervisor(_NoWDT(), '/flash/heap_report.txt')
+    sampler = ADCSampler()
+    app.blynk = blynk = BlynkLib.Blynk(iotdemo.BLYNK_AUTH, connect=False, wdt=supervisor, ssl=True, sampler=sampler)
+    app.email = iotdemo.Email(blynk)
+    blynk.add_virtual_pin(5, write=app.email.handler, cache=True)
+    app.notify = iotdemo.Notify(blynk)
+    blynk.add_virtual_pin(6, write=app.notify.handler, cache=True)
+    app.relay = iotdemo.VirtualSw('GP23')
+    blynk.add_virtual_pin(7, write=app.relay.handler, cache=True)
+    app.battery = iotdemo.BatteryMonitor(sampler, 'GP3')
+    app.task = iotdemo.MainTask(blynk, 'GP30', 'GP17', 'GP14', app.relay, app.email, app.notify, app.battery,
+                                supervisor, 36, iotdemo.MAIN_TASK_PERIOD, sampler=sampler)
+    app.term = blynk.repl(0)
+    return app
+
+def board():
+    # only with the demo not started, see the top of this file
+    named, sizes = measure(_board_app)
+    total = 0
+    for name, obj in named:
+        size = sizes.get(id(obj), 0)
+        total += size
+        print('{:12} {:16} {:6}'.format(name, type(obj).__name__, size))
+    print('{:29} {:6}'.format('total', total))
+
+_LEAVES = (bytes, bytearray, str, int, float, bool, type(None), memoryview)
+
+def _attrs(obj):
+    values = []
+    if hasattr(obj, '__dict__'):
+        values.append(obj.__dict__)
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+def owned_size(obj, reported, seen):
+    if id(obj) in seen or isinstance(obj, _SKIP):
+        return 0
+    seen.add(id(obj))
+    if type(obj).__module__ == 'hostsim':
+        return 0
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _LEAVES):
+        return size
+    if isinstance(obj, types.MethodType):
+        # a bound method keeps its object alive but doesn't own it
+        return size
+    if isinstance(obj, dict):
+        children = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    else:
+        children = _attrs(obj)
+    for child in children:
+        if id(child) in reported:
+            continue
+        size += owned_size(child, reported, seen)
+    return size
+
+def report():
+    import tracemalloc
+    from simdemo import Demo
+    tracemalloc.start()
+    named, sizes = measure(lambda: Demo(0), True)
+    tracemalloc.stop()
+    reported = set(id(obj) for name, obj in named)
+    result = {}
+    for name, obj in named:
+        result[name] = {'class': type(obj).__name__, 'bytes': sizes.get(id(obj), 0),
+                        'cpython_bytes': owned_size(obj, reported, set()),
+                        'slots': hasattr(type(obj), '__slots__')}
+    return result
+
+def main():
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Per object heap footprint of the iotdemo application')
+    parser.add_argument('--out', help='write the report to this file')
+    parser.add_argument('--baseline', help='compare with an earlier report')
+    args = parser.parse_args()
+
+    result = report()
+    total = sum(entry['bytes'] for entry in result.values())
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)['objects']
+        for name, entry in result.items():
+            if name in base:
+                entry['delta'] = entry['bytes'] - base[name]['bytes']
+    out = json.dumps({'total_bytes': total, 'objects': result}, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out + '\n')
+    print(out)
+
+if __name__ == '__main__':
+    main()
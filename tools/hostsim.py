@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+
+# Host (CPython) stand-ins for the MicroPython modules used by the demo,
+# so that BlynkLib and the drivers can be exercised on a PC against the
+# local stub server. Call install() before importing any of the demo
+# modules:
+#
+# import hostsim
+# hostsim.install()
+# import BlynkLib
+#
+# Besides the modules, simple models of the demo hardware are provided:
+# pins that record their writes, ADC inputs, the BH1750FVI and MS5637 on
+# the I2C bus and DS18B20 probes on a OneWire bus.
+
+import builtins
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+_T0 = time.monotonic()
+
+# the simulated hardware, keyed by pin name / I2C address
+pins = {}
+adc_values = {}
+i2c_devices = {}
+# the MicroPython heap as seen by gc.mem_free() / gc.mem_alloc()
+heap = {'size': 57344, 'alloc': 16384}
+
+def _mem_alloc():
+    # while tracemalloc runs the real (CPython) allocations count as well
+    if tracemalloc.is_tracing():
+        return heap['alloc'] + tracemalloc.get_traced_memory()[0]
+    return heap['alloc']
+
+def ticks_ms():
+    return int((time.monotonic() - _T0) * 1000)
+
+def ticks_us():
+    return int((time.monotonic() - _T0) * 1000000)
+
+TICKS_MAX = 0x3FFFFFFF
+
+def ticks_diff(start, end):
+    # same argument order and result as the WiPy port, the elapsed time
+    # masked to a positive small int. An end before start gives a huge value
+    # like on the board, not a negative one
+    return (end - start) & TICKS_MAX
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+class Timer:
+    A = 1
+    B = 2
+    PWM = 3
+    PERIODIC = 4
+    ONE_SHOT = 5
+    TIMEOUT = 1
+
+    def __init__(self, id, mode=None, **kwargs):
+        self.id = id
+        self.mode = mode
+
+    def channel(self, channel, freq=None, period=None, duty_cycle=0, **kwargs):
+        return _TimerChannel(freq, duty_cycle)
+
+class _TimerChannel:
+    # the interrupt handler is called from a thread, so it preempts the
+    # main loop like the real one does
+    def __init__(self, freq, duty_cycle):
+        self.freq = freq
+        self._duty_cycle = duty_cycle
+        self._handler = None
+
+    def irq(self, handler=None, trigger=None, priority=1):
+        self._handler = handler
+        if handler and self.freq:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        period = 1 / self.freq
+        next_time = time.monotonic()
+        while self._handler:
+            next_time += period
+            time.sleep(max(0, next_time - time.monotonic()))
+            handler = self._handler
+            if handler:
+                handler(self)
+
+    def duty_cycle(self, value=None):
+        if value is None:
+            return self._duty_cycle
+        self._duty_cycle = value
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    LOW_POWER = 0
+    MED_POWER = 1
+    HIGH_POWER = 2
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode=IN, pull=None, drive=MED_POWER, alt=-1, value=None):
+        self.id = id
+        if value is None:
+            value = 1 if pull == Pin.PULL_UP else 0
+        self._value = value
+        # called as watcher(pin, value) on every write
+        self.watchers = []
+        self._irq = None
+        self.init(mode, pull)
+        pins[id] = self
+
+    def init(self, mode=IN, pull=None, **kwargs):
+        self.mode = mode
+        self.pull = pull
+        if 'value' in kwargs:
+            self._value = kwargs['value']
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        old, self._value = self._value, value
+        for watcher in self.watchers:
+            watcher(self, value)
+        if self._irq and old != value:
+            trigger, handler = self._irq
+            if trigger & (Pin.IRQ_RISING if value else Pin.IRQ_FALLING):
+                handler(self)
+
+    def irq(self, trigger=IRQ_FALLING | IRQ_RISING, handler=None, **kwargs):
+        self._irq = (trigger, handler) if handler else None
+
+    __call__ = value
+
+class _ADCChannel:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def init(self):
+        pass
+
+    def value(self):
+        return adc_values.get(self.pin, 0)
+
+    __call__ = value
+
+class ADC:
+    def __init__(self, id=0, bits=12):
+        self.bits = bits
+
+    def channel(self, id=None, pin=None):
+        return _ADCChannel(pin)
+
+class I2C:
+    MASTER = 0
+
+    def __init__(self, id=0, mode=MASTER, baudrate=100000, pins=None):
+        self.baudrate = baudrate
+
+    def _dev(self, addr):
+        if addr not in i2c_devices:
+            raise OSError('I2C bus error')
+        return i2c_devices[addr]
+
+    def writeto(self, addr, buf):
+        self._dev(addr).write(buf)
+
+    def readfrom(self, addr, nbytes):
+        return self._dev(addr).read(nbytes)
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        return self._dev(addr).read_mem(memaddr, nbytes)
+
+class SPI:
+    MASTER = 0
+
+    def __init__(self, id=0, mode=MASTER, baudrate=1000000, pins=None, **kwargs):
+        self.baudrate = baudrate
+        self.writes = 0
+
+    def write(self, buf):
+        self.writes += 1
+
+class RTC:
+    def __init__(self, id=0, datetime=None):
+        self.datetime = datetime
+
+class WLAN:
+    STA = 1
+    AP = 2
+    WEP = 1
+    WPA = 2
+    WPA2 = 3
+
+    def __init__(self, mode=STA, **kwargs):
+        self.mode = mode
+
+    def connect(self, ssid, auth=None, timeout=None):
+        pass
+
+    def isconnected(self):
+        return True
+
+class BH1750FVISim:
+    # continuous high resolution mode, counts = lux / 1.2
+    def __init__(self, lux=300):
+        self.lux = lux
+
+    def counts(self):
+        return self.lux * 1000 // 1200
+
+    def reading(self):
+        # what the driver will make out of counts()
+        return self.counts() * 1200 // 1000
+
+    def write(self, buf):
+        pass
+
+    def read(self, nbytes):
+        c = self.counts()
+        return bytes((c >> 8 & 0xFF, c & 0xFF))
+
+class MS5637Sim:
+    # the example values of the datasheet, 2000 (20.00 C) and 110002 (1100.02 mbar)
+    PROM = (0, 46372, 43981, 29059, 27842, 31553, 28165)
+
+    def __init__(self, d1=6465444, d2=8077636):
+        self.d1 = d1
+        self.d2 = d2
+        self._adc = 0
+
+    def write(self, buf):
+        cmd = buf if isinstance(buf, int) else buf[0]
+        if cmd & 0xF0 == 0x40:
+            self._adc = self.d1
+        elif cmd & 0xF0 == 0x50:
+            self._adc = self.d2
+
+    def read_mem(self, memaddr, nbytes):
+        if memaddr == 0:
+            return bytes((self._adc >> 16 & 0xFF, self._adc >> 8 & 0xFF, self._adc & 0xFF))
+        val = self.PROM[(memaddr - 0xA0) // 2]
+        return bytes((val >> 8, val & 0xFF))
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        for b in range(8):
+            mix = (crc ^ byte) & 0x01
+            crc >>= 1
+            if mix:
+                crc ^= 0x8C
+            byte >>= 1
+    return crc
+
+class DS18B20Sim:
+    CONV_MS = {0x1F: 94, 0x3F: 188, 0x5F: 375, 0x7F: 750}
+
+    def __init__(self, serial, temp=2150, parasite=False):
+        rom = bytes((0x28,)) + serial.to_bytes(6, 'little')
+        self.rom = rom + bytes((crc8(rom),))
+        self.temp = temp # in 1/100 C
+        self.parasite = parasite
+        self.th = 0x4B
+        self.tl = 0x46
+        self.config = 0x7F # 12 bit
+        self.eeprom = (self.th, self.tl, self.config)
+        self.conv_end = 0
+        self.value = 0x0550 # 85 C power on value
+
+    def busy(self):
+        if self.conv_end and ticks_ms() >= self.conv_end:
+            self.conv_end = 0
+            raw = self.temp * 16 // 100
+            # the lower resolutions leave the low bits undefined (zero)
+            self.value = raw & ~((1 << (3 - (self.config >> 5))) - 1) & 0xFFFF
+        return self.conv_end != 0
+
+    def convert(self):
+        self.conv_end = ticks_ms() + self.CONV_MS[self.config]
+
+    def scratchpad(self):
+        self.busy()
+        data = bytes((self.value & 0xFF, self.value >> 8, self.th, self.tl, self.config, 0xFF, 0x0C, 0x10))
+        return data + bytes((crc8(data),))
+
+class OneWireBus:
+    """
+    Drop in replacement for onewire.OneWire with DS18B20Sim devices on it.
+    elapsed_us adds up the time the real bus transfers would take.
+    """
+    RESET_US = 960
+    SLOT_US = 62
+
+    def __init__(self, devices=()):
+        self.devices = list(devices)
+        self.elapsed_us = 0
+        self._state = None
+        self._selected = []
+        self._out = []
+        self._match = None
+        self._wdata = None
+        self.pullup = False
+        self.read_slots = 0
+
+    def strong_pullup(self, enable):
+        self.pullup = enable
+
+    def reset(self):
+        self.elapsed_us += self.RESET_US
+        self._state = 'rom'
+        self._selected = []
+        self._out = []
+        return bool(self.devices)
+
+    def read_bit(self):
+        assert not self.pullup, 'bus traffic during the strong pull-up'
+        self.elapsed_us += self.SLOT_US
+        self.read_slots += 1
+        if self._out:
+            return self._out.pop(0)
+        # idle slots read 0 while a conversion is in progress, parasite
+        # powered devices can't pull the line
+        return 0 if any(d.busy() and not d.parasite for d in self.devices) else 1
+
+    def read_byte(self):
+        value = 0
+        for i in range(8):
+            value |= self.read_bit() << i
+        return value
+
+    def read_bytes(self, count):
+        buf = bytearray(count)
+        for i in range(count):
+            buf[i] = self.read_byte()
+        return buf
+
+    def write_bit(self, value):
+        self.elapsed_us += self.SLOT_US
+
+    def write_bytes(self, buf):
+        for b in buf:
+            self.write_byte(b)
+
+    def select_rom(self, rom):
+        self.reset()
+        self.write_byte(0x55)
+        self.write_bytes(rom)
+
+    def _queue(self, data):
+        for byte in data:
+            self._out.extend((byte >> i) & 1 for i in range(8))
+
+    def write_byte(self, value):
+        assert not self.pullup, 'bus traffic during the strong pull-up'
+        self.elapsed_us += 8 * self.SLOT_US
+        state = self._state
+        if state == 'rom':
+            if value == 0x55:
+                self._state = 'match'
+                self._match = bytearray()
+            elif value == 0xCC:
+                self._selected = list(self.devices)
+                self._state = 'func'
+        elif state == 'match':
+            self._match.append(value)
+            if len(self._match) == 8:
+                self._selected = [d for d in self.devices if d.rom == bytes(self._match)]
+                self._state = 'func'
+        elif state == 'func':
+            self._function(value)
+        elif state == 'wdata':
+            self._wdata.append(value)
+            if len(self._wdata) == 3:
+                for d in self._selected:
+                    d.th, d.tl, d.config = self._wdata[0], self._wdata[1], self._wdata[2] | 0x1F
+                self._state = None
+
+    def _function(self, value):
+        self._state = None
+        selected = self._selected
+        if value == 0x44:
+            for d in selected:
+                d.convert()
+        elif value == 0xBE and len(selected) == 1:
+            self._queue(selected[0].scratchpad())
+        elif value == 0x4E:
+            self._state = 'wdata'
+            self._wdata = bytearray()
+        elif value == 0x48:
+            for d in selected:
+                d.eeprom = (d.th, d.tl, d.config)
+        elif value == 0xB8:
+            for d in selected:
+                d.th, d.tl, d.config = d.eeprom
+        elif value == 0xB4:
+            self._out.append(0 if any(d.parasite for d in selected) else 1)
+
+    def crc8(self, data):
+        return crc8(data)
+
+    def scan(self):
+        self.elapsed_us += len(self.devices) * (self.RESET_US + 64 * 3 * self.SLOT_US + 8 * self.SLOT_US)
+        return [bytearray(d.rom) for d in self.devices]
+
+def _reset():
+    raise SystemExit('machine.reset()')
+
+def install():
+    """
+    Register the stand-in modules and the MicroPython builtins.
+    """
+    if 'machine' in sys.modules:
+        return
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    builtins.const = lambda value: value
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    gc.mem_alloc = _mem_alloc
+    gc.mem_free = lambda: heap['size'] - _mem_alloc()
+
+    machine = types.ModuleType('machine')
+    machine.WDT = WDT
+    machine.Timer = Timer
+    machine.Pin = Pin
+    machine.ADC = ADC
+    machine.I2C = I2C
+    machine.SPI = SPI
+    machine.RTC = RTC
+    machine.idle = lambda: time.sleep(0.0005)
+    machine.reset = _reset
+    machine.reset_cause = lambda: machine.PWRON_RESET
+    machine.PWRON_RESET = 0
+    machine.HARD_RESET = 1
+    machine.WDT_RESET = 2
+    machine.DEEPSLEEP_RESET = 3
+    machine.SOFT_RESET = 4
+    machine.disable_irq = lambda: 0
+    machine.enable_irq = lambda state=0: None
+    sys.modules['machine'] = machine
+
+    wipy = types.ModuleType('wipy')
+    wipy.heartbeat = lambda enable=None: None
+    sys.modules['wipy'] = wipy
+
+    network = types.ModuleType('network')
+    network.WLAN = WLAN
+    sys.modules['network'] = network
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Run BlynkLib connected to the local stub server with a 50 ms user task
+# (the period MainTask uses) and report how often the loop woke up and
+# which share of the time it spent sleeping. --flood pushes V9 slider
+# values from the server at the given rate.
+#
+# python3 tools/idle_report.py --seconds 10 [--flood 20]
+
+import argparse
+import json
+import threading
+import time
+
+import hostsim
+hostsim.install()
+
+import BlynkLib
+from stubserver import StubServer
+
+class _Done(Exception):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Blynk loop idle report')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--flood', type=float, default=0, help='V9 writes per second from the server')
+    args = parser.parse_args()
+
+    server = StubServer().start_in_thread()
+    blynk = BlynkLib.Blynk('token', server='127.0.0.1', port=server.port, wdt=False)
+    received = []
+    blynk.add_virtual_pin(9, write=received.append)
+    ticks = [0]
+    end = time.monotonic() + args.seconds
+
+    def task():
+        ticks[0] += 1
+        if time.monotonic() >= end:
+            raise _Done()
+
+    def flood():
+        n = 0
+        while time.monotonic() < end:
+            server.call(server.send_hw, 'vw', 9, n % 11)
+            n += 1
+            time.sleep(1 / args.flood)
+
+    if args.flood:
+        threading.Thread(target=flood, daemon=True).start()
+    blynk.set_user_task(task, 50)
+    try:
+        blynk.run()
+    except _Done:
+        pass
+    stats = blynk.stats
+    print(json.dumps({
+        'seconds': args.seconds,
+        'task_runs': ticks[0],
+        'slider_writes': len(received),
+        'wakeups_per_sec': round(stats['wakeups'] / args.seconds, 1),
+        'idle_ratio_pct': blynk.idle_ratio(),
+        'stats': stats,
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
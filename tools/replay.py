@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Replay a Blynk session recorded with the capture mode of BlynkLib
+# (Blynk(..., capture=FILE) or tools/bench_e2e.py --capture FILE) into the
+# client, without a server. The recorded server stream is fed through a
+# socket pair, either with the original timing or as fast as the client
+# reads it, and the client replies are drained and counted.
+#
+# Reports frames per second and the CPU time of the client thread per
+# frame, to tune _recv, _handle_hw and _send on realistic traffic. By
+# default only the protocol layer runs (all the virtual pins have empty
+# handlers), --demo runs the whole iotdemo application on the simulated
+# hardware instead.
+#
+# python3 tools/replay.py session.cap [--fast] [--session N] [--demo]
+
+import argparse
+import json
+import socket
+import struct
+import threading
+import time
+
+import hostsim
+hostsim.install()
+
+import BlynkLib
+from BlynkLib import CAP_FMT, CAP_HDR_LEN, CAP_RX, CAP_TX, CAP_CONNECT, HDR_FMT, HDR_LEN, MSG_HW, MSG_BRIDGE
+
+class _Done(Exception):
+    pass
+
+def load(path):
+    # the sessions of a capture, as lists of (kind, ms, data) starting at a connect
+    sessions = []
+    with open(path, 'rb') as f:
+        raw = f.read()
+    pos = 0
+    while pos + CAP_HDR_LEN <= len(raw):
+        kind, ms, length = struct.unpack_from(CAP_FMT, raw, pos)
+        pos += CAP_HDR_LEN
+        data = raw[pos:pos + length]
+        pos += length
+        if kind == CAP_CONNECT:
+            sessions.append([])
+        elif sessions:
+            sessions[-1].append((kind, ms, data))
+    return sessions
+
+def frames(stream):
+    # (total, hardware) frames in a byte stream
+    total = hw = 0
+    pos = 0
+    while pos + HDR_LEN <= len(stream):
+        msg_type, msg_id, msg_len = struct.unpack_from(HDR_FMT, stream, pos)
+        pos += HDR_LEN
+        total += 1
+        if msg_type == MSG_HW or msg_type == MSG_BRIDGE:
+            hw += 1
+            pos += msg_len
+    return total, hw
+
+class Replay:
+    def __init__(self, records, fast, demo):
+        self.records = records
+        self.fast = fast
+        self.server, self.client = socket.socketpair()
+        if demo:
+            from simdemo import Demo
+            self.app = Demo(0)
+            self.blynk = self.app.blynk
+        else:
+            self.app = None
+            self.blynk = BlynkLib.Blynk('token', wdt=False)
+            for pin in range(BlynkLib.MAX_VIRTUAL_PINS):
+                self.blynk.add_virtual_pin(pin, read=lambda: None, write=lambda value: None)
+        self.tx = bytearray()
+        self.start = None
+        self.elapsed = 0
+        self.cpu = 0
+
+    def _connect(self):
+        self.blynk.conn = self.client
+        self.blynk.stats['connects'] += 1
+        self.start = time.perf_counter()
+        self.cpu = time.thread_time()
+        threading.Thread(target=self._feed, daemon=True).start()
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _close(self):
+        # the feeder closed its end, everything was read
+        self.elapsed = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self.cpu
+        raise _Done()
+
+    def _feed(self):
+        first = self.records[0][1] if self.records else 0
+        for kind, ms, data in self.records:
+            if kind != CAP_RX or not data:
+                continue
+            if not self.fast:
+                delay = self.start + (ms - first) / 1000 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.server.sendall(data)
+        self.server.shutdown(socket.SHUT_WR)
+
+    def _drain(self):
+        while True:
+            data = self.server.recv(4096)
+            if not data:
+                break
+            self.tx += data
+
+    def run(self):
+        self.blynk._connect = self._connect
+        self.blynk._close = self._close
+        try:
+            self.blynk.run()
+        except _Done:
+            pass
+        rx = b''.join(data for kind, ms, data in self.records if kind == CAP_RX)
+        rec_tx = b''.join(data for kind, ms, data in self.records if kind == CAP_TX)
+        rx_frames, hw_frames = frames(rx)
+        return {
+            'mode': 'fast' if self.fast else 'original',
+            'app': 'demo' if self.app else 'bare',
+            'rx_frames': rx_frames,
+            'hw_frames': hw_frames,
+            'rx_bytes': len(rx),
+            'tx_frames': frames(bytes(self.tx))[0],
+            'recorded_tx_frames': frames(rec_tx)[0],
+            'seconds': round(self.elapsed, 3),
+            'recorded_seconds': round((self.records[-1][1] - self.records[0][1]) / 1000, 3) if self.records else 0,
+            'frames_per_sec': round(rx_frames / self.elapsed) if self.elapsed else 0,
+            'cpu_us_per_frame': round(self.cpu * 1e6 / rx_frames, 2) if rx_frames else 0,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a captured Blynk session into the client')
+    parser.add_argument('capture')
+    parser.add_argument('--fast', action='store_true', help='feed as fast as possible instead of in real time')
+    parser.add_argument('--session', type=int, default=0, help='which connection of the capture to replay')
+    parser.add_argument('--demo', action='store_true', help='run the iotdemo application as well')
+    args = parser.parse_args()
+    sessions = load(args.capture)
+    if args.session >= len(sessions):
+        parser.error('the capture has {} sessions'.format(len(sessions)))
+    print(json.dumps(Replay(sessions[args.session], args.fast, args.demo).run(), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Build the iotdemo application (the same wiring as the main script in
+# iotdemo.py) on top of the simulated hardware in hostsim, connected to
+# a local stub server. Used by the host benchmarks.
+
+import os
+import tempfile
+import hostsim
+hostsim.install()
+
+import BlynkLib
+import onewire
+import iotdemo
+from supervisor import Supervisor
+from sampler import ADCSampler
+from hostsim import BH1750FVISim, MS5637Sim, DS18B20Sim, OneWireBus
+
+class Demo:
+    def __init__(self, port, server='127.0.0.1', probes=1, lux=300, battery_raw=3500, **blynk_args):
+        self.bh1750fvi = hostsim.i2c_devices[iotdemo.BH1750FVI_ADDR] = BH1750FVISim(lux)
+        self.ms5637 = hostsim.i2c_devices[iotdemo.MS5637_ADDR] = MS5637Sim()
+        hostsim.adc_values['GP3'] = battery_raw
+        self.bus = OneWireBus([DS18B20Sim(n + 1) for n in range(probes)])
+        onewire.OneWire = lambda pin: self.bus
+
+        self.wdt = hostsim.WDT(timeout=iotdemo.WDT_TIMEOUT)
+        self.supervisor = Supervisor(self.wdt, os.path.join(tempfile.gettempdir(), 'iotdemo_crash.txt'))
+        self.sampler = ADCSampler()
+        self.blynk = blynk = BlynkLib.Blynk('token', server=server, port=port, wdt=self.supervisor,
+                                            sampler=self.sampler, **blynk_args)
+        self.email = iotdemo.Email(blynk)
+        blynk.add_virtual_pin(5, write=self.email.handler, cache=True)
+        self.notify = iotdemo.Notify(blynk)
+        blynk.add_virtual_pin(6, write=self.notify.handler, cache=True)
+        self.relay = iotdemo.VirtualSw('GP23')
+        blynk.add_virtual_pin(7, write=self.relay.handler, cache=True)
+        self.battery = iotdemo.BatteryMonitor(self.sampler, 'GP3')
+        self.task = iotdemo.MainTask(blynk, 'GP30', 'GP17', 'GP14', self.relay, self.email, self.notify,
+                                     self.battery, self.supervisor, 36, iotdemo.MAIN_TASK_PERIOD,
+                                     sampler=self.sampler)
+        blynk.set_user_task(self.task.run, iotdemo.MAIN_TASK_PERIOD)
+        self.term = blynk.repl(0)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Blynk server. It speaks just enough of the
+# protocol (login, ping and hardware messages) to drive BlynkLib and the
+# host tools without any outside services. Optionally serves TLS with a
+# self-signed CA created by make_test_pki().
+#
+# python3 tools/stubserver.py --port 8442
+# python3 tools/stubserver.py --port 8441 --tls /tmp/pki
+
+import argparse
+import asyncio
+import os
+import ssl
+import struct
+import subprocess
+import threading
+
+import hostsim
+hostsim.install()
+
+from BlynkLib import HDR_FMT, HDR_LEN, MSG_RSP, MSG_LOGIN, MSG_PING, MSG_HW, MSG_HW_SYNC, STA_SUCCESS
+
+STA_INVALID_TOKEN = 9
+
+def make_test_pki(path, host='localhost'):
+    """
+    Create a self-signed CA and a server certificate for host signed by it.
+    Returns (ca_cert, server_cert, server_key) paths.
+    """
+    os.makedirs(path, exist_ok=True)
+    ca_key, ca_crt = os.path.join(path, 'ca.key'), os.path.join(path, 'ca.pem')
+    key, csr, crt = (os.path.join(path, 'server.' + ext) for ext in ('key', 'csr', 'pem'))
+    ext = os.path.join(path, 'server.ext')
+    if os.path.exists(crt):
+        return ca_crt, crt, key
+    run = lambda *args: subprocess.run(('openssl',) + args, check=True, capture_output=True)
+    run('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30', '-subj', '/CN=iotdemo test CA',
+        '-keyout', ca_key, '-out', ca_crt)
+    run('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=' + host, '-keyout', key, '-out', csr)
+    with open(ext, 'w') as f:
+        f.write('subjectAltName=DNS:{}\n'.format(host))
+    run('x509', '-req', '-in', csr, '-CA', ca_crt, '-CAkey', ca_key, '-CAcreateserial',
+        '-days', '30', '-extfile', ext, '-out', crt)
+    return ca_crt, crt, key
+
+def server_context(cert, key):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+class Session:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.token = None
+        self.msg_id = 0
+
+    def send(self, msg_type, *args):
+        data = bytes('\0'.join(map(str, args)), 'ascii')
+        self.msg_id = self.msg_id % 0xFFFF + 1
+        self.writer.write(struct.pack(HDR_FMT, msg_type, self.msg_id, len(data)) + data)
+
+    def respond(self, msg_id, status=STA_SUCCESS):
+        self.writer.write(struct.pack(HDR_FMT, MSG_RSP, msg_id, status))
+
+    def close(self):
+        self.writer.close()
+
+class StubServer:
+    def __init__(self, host='127.0.0.1', port=0, token=None, ssl_ctx=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.ssl_ctx = ssl_ctx
+        self.sessions = set()
+        self.loop = None
+        # callbacks called as on_frame(session, msg_type, msg_id, body, ticks_us)
+        self.on_frame = []
+        self.stats = {'connections': 0, 'logins': 0, 'rejected': 0, 'frames': 0, 'pings': 0, 'bytes': 0,
+                      'syncs': 0}
+        # the virtual pin values the server keeps, as the argument lists of their last 'vw'
+        self.pins = {}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, ssl=self.ssl_ctx,
+                                                  backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def start_in_thread(self):
+        """
+        Run the server in a background thread, returns once it is listening.
+        """
+        ready = threading.Event()
+        def _run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+        threading.Thread(target=_run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def call(self, fn, *args):
+        # thread safe way of calling into the server from the device side
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def send_hw(self, *args):
+        if args[0] == 'vw':
+            self.pins[int(args[1])] = args[2:]
+        for session in list(self.sessions):
+            session.send(MSG_HW, *args)
+
+    def drop_all(self):
+        for session in list(self.sessions):
+            session.close()
+
+    async def _serve(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.stats['connections'] += 1
+        self.sessions.add(session)
+        stats = self.stats
+        try:
+            while True:
+                hdr = await reader.readexactly(HDR_LEN)
+                now = hostsim.ticks_us()
+                msg_type, msg_id, msg_len = struct.unpack(HDR_FMT, hdr)
+                body = b''
+                if msg_type != MSG_RSP and msg_len:
+                    body = await reader.readexactly(msg_len)
+                stats['frames'] += 1
+                stats['bytes'] += HDR_LEN + len(body)
+                if msg_type == MSG_LOGIN:
+                    if self.token is None or body == self.token:
+                        session.token = body
+                        stats['logins'] += 1
+                        session.respond(msg_id)
+                    else:
+                        stats['rejected'] += 1
+                        session.respond(msg_id, STA_INVALID_TOKEN)
+                elif msg_type == MSG_PING:
+                    stats['pings'] += 1
+                    session.respond(msg_id)
+                elif msg_type == MSG_HW:
+                    args = body.decode('ascii').split('\0')
+                    if args[0] == 'vw':
+                        self.pins[int(args[1])] = args[2:]
+                elif msg_type == MSG_HW_SYNC:
+                    # answer with the stored values of the requested pins
+                    args = body.decode('ascii').split('\0')
+                    stats['syncs'] += 1
+                    for pin in args[1:] if args[0] == 'vr' else self.pins:
+                        if int(pin) in self.pins:
+                            session.send(MSG_HW, 'vw', pin, *self.pins[int(pin)])
+                for cb in self.on_frame:
+                    cb(session, msg_type, msg_id, body, now)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Blynk stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8442)
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--tls', metavar='PKI_DIR', help='serve TLS, creating a test CA in PKI_DIR if needed')
+    args = parser.parse_args()
+
+    ctx = None
+    if args.tls:
+        ca, cert, key = make_test_pki(args.tls)
+        ctx = server_context(cert, key)
+        print('CA certificate:', ca)
+    token = bytes(args.token, 'ascii') if args.token else None
+    server = StubServer(args.host, args.port, token, ctx)
+
+    async def _run():
+        await server.start()
+        print('listening on {}:{}'.format(args.host, server.port))
+        while True:
+            await asyncio.sleep(10)
+            print(server.stats)
+    asyncio.run(_run())
+
+if __name__ == '__main__':
+    main()
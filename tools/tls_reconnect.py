@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Reconnect BlynkLib over TLS to the local stub server a number of times
+# and report the TCP connect and TLS handshake times of every attempt,
+# together with whether the TLS session was resumed.
+#
+# python3 tools/tls_reconnect.py --cycles 10
+
+import argparse
+import json
+import tempfile
+
+import hostsim
+hostsim.install()
+
+import BlynkLib
+from stubserver import StubServer, make_test_pki, server_context
+
+class _Done(Exception):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser(description='TLS reconnect timing against the stub server')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--pki', default=tempfile.gettempdir() + '/iotdemo-pki')
+    args = parser.parse_args()
+
+    ca, cert, key = make_test_pki(args.pki)
+    server = StubServer(ssl_ctx=server_context(cert, key)).start_in_thread()
+    blynk = BlynkLib.Blynk('token', server='localhost', port=server.port, wdt=False, ssl=True, ca_certs=ca)
+    results = []
+
+    def task():
+        if blynk.state == BlynkLib.AUTHENTICATED:
+            stats = blynk.stats
+            resumed = stats['tls_resumed'] - sum(r['resumed'] for r in results)
+            results.append({'connect_ms': stats['connect_ms'], 'tls_ms': stats['tls_ms'], 'resumed': resumed})
+            if len(results) == args.cycles:
+                raise _Done()
+            blynk.disconnect()
+        elif not blynk._do_connect:
+            blynk.connect()
+
+    blynk.set_user_task(task, 50)
+    try:
+        blynk.run()
+    except _Done:
+        pass
+    print(json.dumps({'cycles': results, 'stats': blynk.stats}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -17,10 +17,19 @@
 # ]
 # chain.show(data)
 #
+# For a steady frame rate the refresh can be driven by a hardware timer.
+# show() then renders into a back buffer and the timer pushes the latest
+# complete frame on every tick:
+#
+# chain.start(fps=50)
+# chain.show(data)
+#
 # Version: 1.0
 
+import time
 from machine import SPI
 from machine import Pin
+from machine import Timer
 from machine import disable_irq
 from machine import enable_irq
 
@@ -32,6 +41,13 @@ class WS2812:
         # params: * nleds = number of LEDs
 
         self.buf = bytearray(nleds * 3 * 8)  # 1 byte per bit
+        self.back = bytearray(nleds * 3 * 8) # rendered, waiting for the timer
+        self.pending = False
+        self.timer = None
+        self.frames = 0
+        self.dropped = 0
+        self._stats_time = time.ticks_ms()
+        self._stats_frames = 0
         # spi init
         # bus 0, 8MHz => 125 ns by bit, each transfer is 10 cycles long due to the
         # CC3200 spi dead cycles, therefore => 125*10=1.25 us as required by the
@@ -48,21 +64,79 @@ class WS2812:
         self.spi.write(self.buf)
         enable_irq()
 
-    def show(self, data):
+    def show(self, data, rotate=0):
         # show RGB data on the LEDs. Expected data = [(R, G, B), ...] where
         # R, G and B are the intensities of the colors in the range 0 to 255.
         # the number of tuples may be less than the number of connected LEDs.
+        # data may also be a bytearray with R, G, B bytes for each LED, then
+        # rotate moves the pattern by that many LEDs without copying it.
+
+        if self.timer:
+            self.render(data, rotate)
+        else:
+            self.fill(data, None, rotate)
+            self._send()
+
+    def render(self, data, rotate=0):
+        # render a frame into the back buffer, the refresh timer pushes it.
+        # A frame that is replaced before the timer got to it is dropped.
+
+        disable_irq()
+        if self.pending:
+            self.dropped += 1
+            self.pending = False # keeps the timer off the buffer while filling
+        enable_irq()
+        self.fill(data, self.back, rotate)
+        self.pending = True
+
+    def _refresh(self, timer):
+        # timer interrupt, no allocations allowed in here
+
+        if self.pending:
+            self.buf, self.back = self.back, self.buf
+            self.pending = False
+            self.spi.write(self.buf)
+            self.frames += 1
+
+    def start(self, fps=50, timer=0):
+        # push the frames from a hardware timer at a fixed frame rate
+
+        tim = Timer(timer, mode=Timer.PERIODIC)
+        self.timer = tim.channel(Timer.A, freq=fps)
+        self.timer.irq(handler=self._refresh, trigger=Timer.TIMEOUT)
+
+    def stop(self):
+        if self.timer:
+            self.timer.irq(handler=None, trigger=Timer.TIMEOUT)
+            self.timer = None
+
+    def stats(self):
+        # returns (frames per second since the last call, frames pushed, frames dropped)
 
-        self.fill(data)
-        self._send()
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(self._stats_time, now)
+        fps = (self.frames - self._stats_frames) * 1000 // elapsed if elapsed > 0 else 0
+        self._stats_time = now
+        self._stats_frames = self.frames
+        return (fps, self.frames, self.dropped)
 
-    def update(self, data, start=0):
+    def update(self, data, start=0, buf=None, rotate=0):
         # fill a part of the buffer with RGB data.
         # Returns the index of the first unfilled LED.
 
-        buf = self.buf
+        buf = self.buf if buf is None else buf
         bits = self.bits
         idx = start * 24
+        if isinstance(data, (bytes, bytearray)):
+            nleds = len(data) // 3
+            for n in range(nleds):
+                pos = (n + rotate) % nleds * 3
+                for c in (1, 0, 2): # the WS2812 requires GRB
+                    color = data[pos + c]
+                    for bit in range (0, 8):
+                        buf[idx + bit] = bits[color >> (7 - bit) & 0x01]
+                    idx += 8
+            return idx // 24
         for colors in data:
             for c in (1, 0, 2): # the WS2812 requires GRB
                 color = colors[c]
@@ -71,12 +145,12 @@ class WS2812:
                 idx += 8
         return idx // 24
 
-    def fill(self, data):
+    def fill(self, data, buf=None, rotate=0):
         # fill the buffer with RGB data.
         # all the LEDs after the data are turned off.
 
-        end = self.update(data)
-        buf = self.buf
+        buf = self.buf if buf is None else buf
+        end = self.update(data, 0, buf, rotate)
         off = self.bits[0]
-        for idx in range(end * 24, len(self.buf)):
+        for idx in range(end * 24, len(buf)):
             buf[idx] = off